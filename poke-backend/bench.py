@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import math
+import os
+import random
+import resource
+import time
+import tracemalloc
+from datetime import datetime
+from typing import List, Optional
+
+from server.history import MAX_CONVERSATION_HISTORY, ConversationHistory
+
+SAMPLE_MESSAGE = "Sounds good, let's pick this up tomorrow morning."
+
+# Read-only tools the fake model calls, in rotation
+BENCH_TOOLS = [
+    "GMAIL_GET_PROFILE",
+    "GMAIL_SEARCH_PEOPLE",
+    "COMPOSIO_SEARCH_SEARCH",
+    "COMPOSIO_SEARCH_EXA_ANSWER",
+]
+
+
+def _list_history(turns: int) -> list:
+    """The previous layout: a sliced list of dicts with ISO timestamps"""
+    history = []
+    for i in range(turns):
+        history.append({
+            "message": SAMPLE_MESSAGE,
+            "type": "user" if i % 2 == 0 else "agent",
+            "timestamp": datetime.now().isoformat(),
+        })
+        if len(history) > MAX_CONVERSATION_HISTORY:
+            history = history[-MAX_CONVERSATION_HISTORY:]
+    return history
+
+
+def _ring_history(turns: int) -> ConversationHistory:
+    history = ConversationHistory()
+    for i in range(turns):
+        history.append(SAMPLE_MESSAGE, "user" if i % 2 == 0 else "agent")
+    return history
+
+
+def _measure(build, users: int, turns: int) -> tuple:
+    """Build histories for every user, returning (bytes per user, seconds)"""
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    histories = {f"user-{n}": build(turns) for n in range(users)}
+    elapsed = time.perf_counter() - started
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del histories
+    return allocated / users, elapsed
+
+
+def _append_cost(build, appends: int) -> float:
+    """Microseconds per append once a history is full"""
+    started = time.perf_counter()
+    build(MAX_CONVERSATION_HISTORY + appends)
+    return (time.perf_counter() - started) / (MAX_CONVERSATION_HISTORY + appends) * 1e6
+
+
+def bench_history(args):
+    """Compare the per-user footprint of the old and new history layouts"""
+    print(f"{args.users:,} users x {args.turns} turns (message text shared, so only structure is counted)")
+    for name, build in (("list of dicts", _list_history), ("ring buffer", _ring_history)):
+        per_user, elapsed = _measure(build, args.users, args.turns)
+        print(
+            f"  {name:<14} {per_user:>8,.0f} B/user  {per_user * args.users / 2**20:>8,.1f} MiB total"
+            f"  built in {elapsed:.1f}s  {_append_cost(build, 10_000):.2f} us/append when full"
+        )
+
+
+class Latency:
+    """Seconds to sleep per call, drawn from a distribution given as a spec
+
+    "0.2" is fixed, "uniform:0.1,0.5" is uniform between bounds and
+    "lognormal:0.3,0.5" has a median of 0.3s and sigma 0.5
+    """
+
+    def __init__(self, spec: str, rng: random.Random):
+        kind, _, params = spec.partition(":") if ":" in spec else ("fixed", "", spec)
+        self.kind = kind
+        self.params = [float(param) for param in params.split(",")]
+        self.rng = rng
+        expected = {"fixed": 1, "uniform": 2, "lognormal": 2}.get(kind)
+        if expected != len(self.params):
+            raise argparse.ArgumentTypeError(f"invalid latency: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "uniform":
+            return self.rng.uniform(*self.params)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return self.rng.lognormvariate(math.log(median), sigma)
+        return self.params[0]
+
+
+def _fake_chat_model(latency: Latency, tool_pattern: List[int], response_words: int, query_pool: int):
+    """A chat model that calls tools in a fixed pattern, then answers
+
+    tool_pattern[n] is how many parallel tool calls the model makes in the
+    nth round of a turn; query_pool bounds distinct tool arguments, which
+    sets the tool result cache hit rate.
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+    from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+    class FakeChatModel(BaseChatModel):
+        tools_bound: bool = False
+        calls: int = 0
+
+        @property
+        def _llm_type(self) -> str:
+            return "poke-bench-fake"
+
+        def bind_tools(self, tools, **kwargs):
+            return self.model_copy(update={"tools_bound": True})
+
+        def _reply(self, messages) -> AIMessage:
+            # The binding made by bind_tools is a copy, so count on the original
+            model.calls += 1
+            turn = [message for message in messages if isinstance(message, HumanMessage)][-1]
+            rounds = sum(
+                1 for message in messages[messages.index(turn):]
+                if isinstance(message, AIMessage) and message.tool_calls
+            )
+            # Roughly four characters per token, like the context builder's estimate
+            usage = {"input_tokens": sum(len(str(message.content)) for message in messages) // 4 + 1}
+            if self.tools_bound and rounds < len(tool_pattern):
+                usage.update(output_tokens=16 * tool_pattern[rounds])
+                usage.update(total_tokens=usage["input_tokens"] + usage["output_tokens"])
+                return AIMessage(content="", usage_metadata=usage, tool_calls=[
+                    {
+                        "name": BENCH_TOOLS[(rounds + n) % len(BENCH_TOOLS)],
+                        "args": {"query": f"query {random.randrange(query_pool)}"},
+                        "id": f"call-{model.calls}-{n}",
+                    }
+                    for n in range(tool_pattern[rounds])
+                ])
+            usage.update(output_tokens=response_words, total_tokens=usage["input_tokens"] + response_words)
+            return AIMessage(content=" ".join(["word"] * response_words), usage_metadata=usage)
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(latency.sample())
+            return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(latency.sample())
+            return ChatResult(generations=[ChatGeneration(message=self._reply(messages))])
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(latency.sample())
+            reply = self._reply(messages)
+            if reply.tool_calls:
+                yield ChatGenerationChunk(message=AIMessageChunk(
+                    content="",
+                    usage_metadata=reply.usage_metadata,
+                    tool_call_chunks=[
+                        {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": n}
+                        for n, call in enumerate(reply.tool_calls)
+                    ],
+                ))
+                return
+            for word in reply.content.split(" "):
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            # Usage arrives on a final empty chunk, as with stream_usage on OpenAI
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=reply.usage_metadata))
+
+    model = FakeChatModel()
+    return model
+
+
+class FakeComposio:
+    """Stands in for the Composio client; its tools sleep instead of calling out"""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.tools = self
+        self.calls = 0
+
+    def get(self, user_id: str, tools: Optional[List[str]] = None, **kwargs) -> list:
+        from langchain_core.tools import StructuredTool
+
+        def make(name: str):
+            def run(query: str = "") -> dict:
+                # Runs in the tool thread pool, like the real synchronous SDK
+                self.calls += 1
+                time.sleep(self.latency.sample())
+                return {"successful": True, "data": {"tool": name, "query": query}, "error": None}
+            return StructuredTool.from_function(run, name=name, description=f"Fake {name}")
+
+        return [make(name) for name in tools or BENCH_TOOLS]
+
+
+def _percentile(ordered: List[float], q: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _rss_mib() -> float:
+    """Current resident set size"""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+async def _send_and_wait(http, user_id: str, content: str, args, latencies: List[float], outcomes: dict) -> None:
+    """POST a message, then poll its response until it finishes or times out"""
+    started = time.perf_counter()
+    response = await http.post("/messages", json={"user_id": user_id, "content": content})
+    if response.status_code == 429:
+        outcomes["rejected"] += 1
+        return
+    message_id = response.json()["message_id"]
+    deadline = started + args.timeout
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(args.poll_interval)
+        status = (await http.get(f"/messages/{message_id}/response")).json()["status"]
+        if status != "processing":
+            outcomes[status] += 1
+            latencies.append(time.perf_counter() - started)
+            return
+    outcomes["timeout"] += 1
+
+
+async def _drive(api, users: List[str], args, clients) -> dict:
+    """Run the embedded processor while clients(http, latencies, outcomes) sends
+    traffic through the app, then report on it"""
+    import httpx
+
+    from server.models import User
+
+    for user_id in users:
+        await api.storage.save_user(User(connection_id=user_id))
+
+    latencies: List[float] = []
+    outcomes = {"completed": 0, "error": 0, "rejected": 0, "timeout": 0}
+    processor = api.message_processor
+    worker = asyncio.create_task(processor.start_processing())
+    rss_start = _rss_mib()
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout) as http:
+        await clients(http, latencies, outcomes)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_start
+    stats = await processor.get_stats()
+    await processor.stop_processing()
+    worker.cancel()
+    await asyncio.gather(worker, return_exceptions=True)
+
+    rss_end = _rss_mib()
+    ordered = sorted(latencies)
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "cpu_s": round(cpu, 3),
+        "throughput_per_s": round(len(ordered) / elapsed, 2),
+        "latency_s": {
+            name: round(value, 4) if value is not None else None
+            for name, value in (
+                ("p50", _percentile(ordered, 0.50)),
+                ("p95", _percentile(ordered, 0.95)),
+                ("p99", _percentile(ordered, 0.99)),
+                ("max", ordered[-1] if ordered else None),
+            )
+        },
+        "outcomes": outcomes,
+        "queue_wait_s": {lane: data["queue_wait"] for lane, data in stats["lanes"].items() if data["count"]},
+        "memory_mib": {
+            "rss_start": round(rss_start, 1),
+            "rss_end": round(rss_end, 1),
+            # ru_maxrss is in KiB on Linux
+            "rss_peak": round(max(rss_end, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024), 1),
+        },
+        "responses": stats["responses"],
+        "cassette": stats["cassette"],
+    }
+
+
+async def _run_load(args) -> dict:
+    from server import api
+
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    model = _fake_chat_model(
+        Latency(args.llm_latency, rng), args.tool_pattern, args.response_words, args.query_pool
+    )
+    composio = FakeComposio(Latency(args.tool_latency, rng))
+    processor = api.message_processor
+    processor.agent.model = model
+    processor.agent.composio = composio
+    processor.context.model = model
+
+    users = [f"bench-user-{n}" for n in range(args.users)]
+    next_request = iter(range(args.requests))
+
+    async def clients(http, latencies, outcomes):
+        async def client():
+            for n in next_request:
+                await _send_and_wait(http, users[n % len(users)], f"message {n}", args, latencies, outcomes)
+
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+
+    report = await _drive(api, users, args, clients)
+    report.update(requests=args.requests, model_calls=model.calls, tool_calls=composio.calls)
+    return report
+
+
+async def _run_replay(args) -> dict:
+    from server import api
+    from server.cassette import cassette
+
+    messages = cassette.messages[:args.requests] if args.requests else cassette.messages
+    users = sorted({user_id for _, user_id, _ in messages})
+
+    async def clients(http, latencies, outcomes):
+        started = time.perf_counter()
+
+        async def send(at: float, user_id: str, content: str):
+            # Arrive on the recorded schedule, scaled like the call timings
+            await asyncio.sleep(max(0.0, started + at * args.time_scale - time.perf_counter()))
+            await _send_and_wait(http, user_id, content, args, latencies, outcomes)
+
+        await asyncio.gather(*(send(*message) for message in messages))
+
+    report = await _drive(api, users, args, clients)
+    report.update(requests=len(messages), users=len(users))
+    return report
+
+
+def _run_quietly(run, args) -> dict:
+    """Run a benchmark against an in-process server with its logging silenced"""
+    # Set before the server modules read them at import
+    os.environ.setdefault("COMPOSIO_API_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["MESSAGE_WORKERS"] = str(args.workers)
+    # Admission control would shed the synthetic load it is meant to measure
+    for name in ("MAX_IN_FLIGHT", "MAX_USER_IN_FLIGHT", "USER_RATE_LIMIT"):
+        os.environ.setdefault(name, "0")
+
+    # The agent and processor log every message; that would dominate the timings
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        import logging
+
+        logging.disable(logging.WARNING)
+        return asyncio.run(run(args))
+
+
+def bench_load(args):
+    """Drive the API with fake model and tool latencies and report throughput"""
+    print(
+        f"{args.requests:,} messages from {args.users:,} users, {args.concurrency} clients, "
+        f"{args.workers} workers; model latency {args.llm_latency}, tool latency {args.tool_latency}, "
+        f"tool calls per round {','.join(map(str, args.tool_pattern)) or 'none'}"
+    )
+    print(json.dumps(_run_quietly(_run_load, args), indent=2))
+
+
+def bench_replay(args):
+    """Replay a recorded cassette against the current server code"""
+    os.environ["CASSETTE_MODE"] = "replay"
+    os.environ["CASSETTE_PATH"] = args.cassette
+    os.environ["CASSETTE_TIME_SCALE"] = str(args.time_scale)
+    print(f"Replaying {args.cassette} with timings x{args.time_scale:g}, {args.workers} workers")
+    print(json.dumps(_run_quietly(_run_replay, args), indent=2))
+
+
+def _latency_spec(value: str) -> str:
+    Latency(value, random.Random())
+    return value
+
+
+def _tool_pattern(value: str) -> List[int]:
+    return [int(calls) for calls in value.split(",") if calls.strip()]
+
+
+def main():
+    """Run micro-benchmarks for the backend"""
+    parser = argparse.ArgumentParser(description="Poke backend benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    history = subparsers.add_parser("history", help="Conversation history memory footprint")
+    history.add_argument("--users", type=int, default=100_000, help="Active users (default: 100000)")
+    history.add_argument(
+        "--turns", type=int, default=MAX_CONVERSATION_HISTORY, help="Turns per user (default: 50)"
+    )
+    history.set_defaults(func=bench_history)
+
+    load = subparsers.add_parser(
+        "load", help="End-to-end load test through the API with a fake model and fake Composio"
+    )
+    load.add_argument("--requests", type=int, default=500, help="Messages to send (default: 500)")
+    load.add_argument("--concurrency", type=int, default=50, help="Concurrent clients (default: 50)")
+    load.add_argument("--users", type=int, default=100, help="Distinct users (default: 100)")
+    load.add_argument("--workers", type=int, default=8, help="Message workers (default: 8)")
+    load.add_argument(
+        "--llm-latency", type=_latency_spec, default="lognormal:0.2,0.4",
+        help="Seconds per model call: N, uniform:LO,HI or lognormal:MEDIAN,SIGMA",
+    )
+    load.add_argument(
+        "--tool-latency", type=_latency_spec, default="uniform:0.05,0.2", help="Seconds per tool call, same forms"
+    )
+    load.add_argument(
+        "--tool-pattern", type=_tool_pattern, default=[2, 1],
+        help="Parallel tool calls per model round before answering, e.g. 2,1 (empty for none)",
+    )
+    load.add_argument("--query-pool", type=int, default=20, help="Distinct tool arguments (default: 20)")
+    load.add_argument("--response-words", type=int, default=40, help="Words per answer (default: 40)")
+    load.add_argument("--poll-interval", type=float, default=0.05, help="Seconds between response polls")
+    load.add_argument("--timeout", type=float, default=120, help="Seconds before a message counts as timed out")
+    load.add_argument("--seed", type=int, default=0)
+    load.set_defaults(func=bench_load)
+
+    replay = subparsers.add_parser(
+        "replay", help="Replay a cassette recorded with CASSETTE_MODE=record, with no network"
+    )
+    replay.add_argument("cassette", help="Cassette file, e.g. poke-cassette.jsonl.gz")
+    replay.add_argument(
+        "--time-scale", type=float, default=1.0,
+        help="Multiply recorded arrival times and call durations (0 = as fast as possible)",
+    )
+    replay.add_argument("--requests", type=int, default=0, help="Replay only the first N messages")
+    replay.add_argument("--workers", type=int, default=8, help="Message workers (default: 8)")
+    replay.add_argument("--poll-interval", type=float, default=0.05, help="Seconds between response polls")
+    replay.add_argument("--timeout", type=float, default=300, help="Seconds before a message counts as timed out")
+    replay.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,14 +15,17 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'server'))
 
 from server.agent import PokeAgent
 from server.models import User
-from server.connection import initiate_connection, get_connection_status
-from composio import Composio
+from server.connection import initiate_connection
+from server.connection_watcher import ConnectionWatcher
+from server.storage import create_storage
+from server.constants import composio
 
 
 class PokeChat:
     def __init__(self):
         self.agent = PokeAgent()
-        self.composio_client = Composio()
+        self.composio_client = composio
+        self.storage = create_storage()
         self.current_user_id = None
         self.gmail_connected = False
     
@@ -58,7 +61,7 @@ class PokeChat:
             email=email
         )
         
-        success = self.redis_client.save_user(user)
+        success = await self.storage.save_user(user)
         if success:
             self.current_user_id = user_id
             self.print_slow(f"\n✨ Great to meet you, {name}!")
@@ -83,17 +86,16 @@ class PokeChat:
             print(f"   {connected_account.redirect_url}")
             print("\n⏳ Waiting for you to complete the authorization...")
             
-            # Wait for connection
+            # Wait for connection; the watcher polls with backoff and
+            # returns as soon as the status changes
+            watcher = ConnectionWatcher(self.composio_client)
+            watcher.watch(connected_account.id, user_id)
+            status = None
             max_attempts = 60  # 5 minutes
             for attempt in range(max_attempts):
-                await asyncio.sleep(5)
+                status = await watcher.get_status(connected_account.id, status, wait=5)
                 
-                status = get_connection_status(
-                    connected_account_id=connected_account.id,
-                    composio_client=self.composio_client
-                )
-                
-                if status.status == "ACTIVE":
+                if status == "ACTIVE":
                     self.print_slow("\n🎉 Gmail connected successfully!")
                     self.gmail_connected = True
                     
@@ -102,7 +104,7 @@ class PokeChat:
                     print("🤖 analyzing your emails and searching online...", end='', flush=True)
                     
                     # Get user info for research
-                    user = self.redis_client.get_user(user_id)
+                    user = await self.storage.get_user(user_id)
                     user_name = user.name if user and user.name else "User"
                     user_email = user.email if user and user.email else ""
                     
@@ -117,7 +119,7 @@ class PokeChat:
                     
                     # Skip the proactive intro since we already did research
                     return True
-                elif status.status == "FAILED":
+                elif status == "FAILED":
                     print(f"\n❌ Connection failed: {status}")
                     return False
                 
@@ -183,7 +185,7 @@ class PokeChat:
     
     async def send_proactive_intro(self, user_id: str):
         """Send an initial proactive introduction message"""
-        user = self.redis_client.get_user(user_id)
+        user = await self.storage.get_user(user_id)
         if user and user.name:
             intro_prompt = f"Generate a friendly, personal introduction message for {user.name}. Ask them about their day or what they'd like help with. Be warm and conversational."
         else:
@@ -195,8 +197,8 @@ class PokeChat:
     
     async def show_user_info(self, user_id: str):
         """Show user information and memory"""
-        user = self.redis_client.get_user(user_id)
-        memory = self.redis_client.get_user_memory(user_id)
+        user = await self.storage.get_user(user_id)
+        memory = await self.storage.get_user_memory(user_id)
         
         if not user:
             print("❌ User not found")
@@ -206,18 +208,9 @@ class PokeChat:
         print(f"ID: {user.connection_id}")
         print(f"Name: {user.name}")
         print(f"Email: {user.email}")
-        print(f"Phone: {user.phone}")
-        print(f"Created: {user.created_at}")
-        print(f"Updated: {user.updated_at}")
         
-        print(f"\n🧠 Memory & Insights:")
-        print(f"Insights: {len(memory.insights)} items")
+        print(f"\n🧠 Memory:")
         print(f"Conversation history: {len(memory.conversation_history)} messages")
-        
-        if memory.insights:
-            print("\n📝 Key insights:")
-            for key, value in memory.insights.items():
-                print(f"  • {key}: {value}")
 
 
 async def main():
@@ -267,7 +260,7 @@ async def advanced_main():
     
     # Handle existing user
     if args.user_id:
-        user = poke.redis_client.get_user(args.user_id)
+        user = await poke.storage.get_user(args.user_id)
         if not user:
             print(f"❌ User {args.user_id} not found")
             return
@@ -284,7 +277,7 @@ async def advanced_main():
         if args.name:
             user_id = str(uuid.uuid4())
             user = User(connection_id=user_id, name=args.name, email=args.email)
-            poke.redis_client.save_user(user)
+            await poke.storage.save_user(user)
             poke.current_user_id = user_id
         else:
             user_id = await poke.setup_user()
@@ -1,13 +1,40 @@
+import argparse
+import os
+import tempfile
+
 import uvicorn
-from server.api import app
+from dotenv import load_dotenv
+
 
 def main():
     """Run the FastAPI server"""
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Poke AI API server")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("API_WORKERS", "1")),
+        help="Number of API processes; more than one runs in production mode without reload",
+    )
+    parser.add_argument("--no-reload", action="store_true", help="Disable auto-reload")
+    args = parser.parse_args()
+
+    if args.workers > 1 and os.getenv("STORAGE_BACKEND", "memory") != "redis":
+        print("⚠️  Multiple API processes need STORAGE_BACKEND=redis to share users and messages")
+    if args.workers > 1 and not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # The processes share one port, so each writes its metrics to files
+        # here and /metrics adds them all up, whichever process serves it
+        os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="poke-metrics-")
+
     uvicorn.run(
         "server.api:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        reload=args.workers == 1 and not args.no_reload,
     )
 
 
@@ -0,0 +1,127 @@
+import math
+import os
+import time
+from typing import Optional
+
+from .cache import TTLCache
+from .storage import Storage
+
+# 0 disables the corresponding limit
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "1000"))
+MAX_USER_IN_FLIGHT = int(os.getenv("MAX_USER_IN_FLIGHT", "5"))
+USER_RATE_LIMIT = float(os.getenv("USER_RATE_LIMIT", "1.0"))  # messages per second
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "5"))
+
+# Retry-After bounds in seconds, and the fallback before any drain rate is known
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+DEFAULT_RETRY_AFTER = 5
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at rate tokens per second"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def try_acquire(self) -> float:
+        """Take a token, returning 0 on success or the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Rejects messages past the in-flight limits or a user's rate limit"""
+
+    def __init__(
+        self,
+        storage: Storage,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        max_user_in_flight: int = MAX_USER_IN_FLIGHT,
+        user_rate: float = USER_RATE_LIMIT,
+        user_burst: int = USER_RATE_BURST,
+    ):
+        self.storage = storage
+        self.max_in_flight = max_in_flight
+        self.max_user_in_flight = max_user_in_flight
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        # An idle bucket refills completely in burst / rate seconds, after
+        # which dropping it is the same as keeping a full one
+        self.buckets = TTLCache(
+            max_size=100_000, ttl=user_burst / user_rate if user_rate > 0 else None
+        )
+        self.rejected = {"global_in_flight": 0, "user_in_flight": 0, "rate_limited": 0}
+        # Smoothed completions per second, sampled from the shared counter
+        self.drain_rate: Optional[float] = None
+        self._last_sample: Optional[tuple] = None
+
+    async def check(self, user_id: str, rate_limited: bool = True) -> Optional[int]:
+        """Return None to admit the message, or the Retry-After seconds to reject it
+
+        rate_limited=False checks only the in-flight limits, for work the
+        server starts on the user's behalf.
+        """
+        # In-flight limits first, so a message rejected for them doesn't also
+        # spend one of the user's rate tokens
+        if self.max_in_flight or self.max_user_in_flight:
+            total, user = await self.storage.get_in_flight(user_id)
+            await self._sample_drain_rate()
+            if self.max_in_flight and total >= self.max_in_flight:
+                self.rejected["global_in_flight"] += 1
+                return self._retry_after(total - self.max_in_flight + 1)
+            if self.max_user_in_flight and user >= self.max_user_in_flight:
+                self.rejected["user_in_flight"] += 1
+                # A user's messages run one at a time, so each one ahead costs
+                # a full turn rather than a share of the pool
+                return self._retry_after((user - self.max_user_in_flight + 1) * max(total, 1))
+
+        if rate_limited and self.user_rate > 0:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(self.user_rate, self.user_burst)
+                self.buckets.set(user_id, bucket)
+            wait = bucket.try_acquire()
+            if wait:
+                self.rejected["rate_limited"] += 1
+                return self._clamp(wait)
+        return None
+
+    async def _sample_drain_rate(self) -> None:
+        now = time.monotonic()
+        if self._last_sample and now - self._last_sample[0] < 1:
+            return
+        completed = await self.storage.get_completed_total()
+        if self._last_sample:
+            sampled_at, previous = self._last_sample
+            rate = (completed - previous) / (now - sampled_at)
+            self.drain_rate = rate if self.drain_rate is None else 0.8 * self.drain_rate + 0.2 * rate
+        self._last_sample = (now, completed)
+
+    def _retry_after(self, excess: int) -> int:
+        """Seconds until excess messages drain at the current completion rate"""
+        if not self.drain_rate:
+            return DEFAULT_RETRY_AFTER
+        return self._clamp(excess / self.drain_rate)
+
+    @staticmethod
+    def _clamp(seconds: float) -> int:
+        return max(MIN_RETRY_AFTER, min(MAX_RETRY_AFTER, math.ceil(seconds)))
+
+    def get_stats(self) -> dict:
+        """Get rejection counters and the observed drain rate"""
+        return {
+            "rejected": dict(self.rejected),
+            "drain_rate": self.drain_rate,
+            "tracked_users": len(self.buckets),
+        }
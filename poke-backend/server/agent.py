@@ -1,23 +1,71 @@
-from langchain_core.messages import HumanMessage
+import logging
+import os
+from typing import Awaitable, Callable, List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage
 from langgraph.graph import StateGraph, MessagesState, START, END
 from langgraph.prebuilt import ToolNode, tools_condition
 
+from .cache import TTLCache
+from .cassette import CassetteRecorder, ReplayChatModel, cassette
 from .constants import composio, openai
+from .lanes import RESEARCH, classify_message
+from .metrics import GRAPH_BUILD, llm_metrics
+from .prompts import RESEARCH_REQUEST, SYSTEM_PROMPTS
+from .tools import (
+    get_cached_google_tools,
+    get_tool_result_stats,
+    invalidate_tool_schemas,
+    tool_schema_cache,
+    tool_turn,
+)
+
+logger = logging.getLogger(__name__)
+
+GRAPH_CACHE_SIZE = int(os.getenv("GRAPH_CACHE_SIZE", "1000"))
+GRAPH_CACHE_TTL = float(os.getenv("GRAPH_CACHE_TTL", "3600"))
+
+
+class PokeState(MessagesState):
+    # chat, game or research; picks the system prompt for every model call in the turn
+    mode: str
 
 
 class PokeAgent:
     def __init__(self):
-        self.model = openai
+        # With CASSETTE_MODE=replay, model replies come from a recording
+        self.model = ReplayChatModel(cassette=cassette) if cassette and cassette.mode == "replay" else openai
         self.composio = composio
+        # Attached to every model call; CASSETTE_MODE=record also captures them
+        self.callbacks = [llm_metrics]
+        if cassette and cassette.mode == "record":
+            self.callbacks.append(CassetteRecorder(cassette))
+        # Compiled graphs keyed by user_id, stored with their tool fingerprint
+        self.graph_cache = TTLCache(max_size=GRAPH_CACHE_SIZE, ttl=GRAPH_CACHE_TTL)
         
-    async def process_message(self, user_id: str, message: str) -> str:
-        """Process a user message"""
+    async def process_message(
+        self,
+        user_id: str,
+        message: str,
+        on_event: Optional[Callable[[dict], Awaitable[None]]] = None,
+        history: Optional[List[BaseMessage]] = None,
+        mode: Optional[str] = None,
+    ) -> str:
+        """Process a user message after the history from ContextBuilder, reporting
+        tokens and tool progress to on_event
+
+        mode is the message's lane when the caller already classified it.
+        """
         print(f"Debug: Processing message for user {user_id}")
+        history = history or []
+        mode = mode or classify_message(message)
+        if mode == RESEARCH:
+            # Research triggers all run the same request
+            message = RESEARCH_REQUEST
         
         # Get Gmail and search tools for the user
         try:
-            from .tools import get_google_tools
-            tools = get_google_tools(self.composio, user_id)
+            tools = await get_cached_google_tools(self.composio, user_id)
             print(f"Debug: Got {len(tools)} tools (Gmail + Search)")
             
         except Exception as e:
@@ -25,192 +73,99 @@ class PokeAgent:
             tools = []
         
         if tools:
-            # Create model with tools and build graph
-            model_with_tools = self.model.bind_tools(tools)
-            tool_node = ToolNode(tools)
-            
-            # Build simple graph with Poke personality
-            def call_model_with_system(state):
-                # Check if this is initial research or normal conversation
-                current_message = state["messages"][-1].content
-                is_research_mode = ("Hello Poke" in current_message or 
-                                  "SYSTEM: Perform initial research" in current_message or
-                                  "Research this user automatically" in current_message)
+            graph = self._get_graph(user_id, tools)
+            state = {"messages": history + [HumanMessage(content=message)], "mode": mode}
                 
-                # Check for Game Mode (injected by Telegram Bridge)
-                is_game_mode = "Current Game State" in current_message
-                
-                if is_game_mode:
-                    system_content = """
-You are the Dungeon Master for a text-based adventure game.
-The user is the player.
-You have received the [SYSTEM DATA] with the Current Game State.
-
-YOUR GOAL:
-1. Narrate the result of the user's action. Be descriptive and immersive.
-2. IMPORTANT: If the user's action changes the state (moves location, picks up item, takes damage), you MUST include the updated JSON state at the end of your message in a ```json block.
-"""
-                elif is_research_mode:
-                    system_content = """
-You are Poke 🌴 — a digital bouncer who sizes people up before deciding if they're worth your time. You research everyone who walks through your door using their Gmail data and web searches, then greet them with what you've found.
-
-## Your Core Identity
-You're like a bouncer at an exclusive club - you do your homework on everyone before they even get to talk. You start every interaction with "So you are [Full Name]" followed by what you've discovered about them. You're sizing them up, deciding if they're interesting enough to engage with. You're not eager to help - you're evaluating whether they deserve your attention.
-
-Your vibe: Cool, observant, slightly judgmental but not hostile. You speak like someone who's seen it all and can read people instantly. You're not trying to impress anyone - they need to impress you.
-
-## Research Strategy
-
-### Phase 1: Gmail Profile & Domain Analysis  
-- Get Gmail profile for name and basic details
-- **Analyze email domain** - if not generic provider (gmail, yahoo, outlook, hotmail, icloud), extract company name:
-  - john@acme.dev → company is likely "acme" 
-  - sarah@techstartup.ai → company is likely "techstartup"
-  - Skip generic providers: gmail.com, yahoo.com, outlook.com, hotmail.com, icloud.com, etc.
-- **Use GMAIL_SEARCH_PEOPLE** to search ONLY with the user's FULL NAME (not email address)
-- Look for professional profiles (LinkedIn, company pages, professional directories)
-- Extract PERSONAL professional details about them as an individual:
-  - Current company and job title (from any source)
-  - Their individual background, education, previous experience
-  - Their specific skills, technologies they work with personally
-  - Their personal projects, contributions, achievements
-  - Their role and what they personally do (not just company they work for)
-  - Location and experience level
-
-### Phase 2: Targeted Web Research
-- Use **COMPOSIO_SEARCH** with any gathered professional data AND email domain company
-- Search combinations like:
-  - "{User Name}" + "{Email Domain Company}" + recent news/achievements
-  - "{User Name}" + "{Personal Skills/Technologies}" + projects
-  - "{User Name}" + "{Education/Background}" + personal achievements  
-  - "{User Name}" + personal projects, contributions, or work they've done
-  - "{User Name}" + speaking, writing, or personal professional activities
-- Cross-reference multiple sources for consistency about THEM personally
-- Look for their individual work, personal projects, contributions
-- Find their speaking events, publications, personal professional activities
-- Gather information about THEM as a person, not just company news
-
-### Phase 3: Personal Profile Assembly
-- Cross-reference all gathered data from multiple sources about THEM personally
-- Verify their individual background, skills, and personal work across sources
-- Confirm their personal projects, achievements, and individual contributions
-- Build confident profile of THEM as a person, not their company
-
-## Available Tools
-- **GMAIL_SEARCH_PEOPLE**: Search using the user's COMPLETE FULL NAME (first name + last name together, NOT just first name) to find professional profiles and contact information
-- **GMAIL tools**: Profile access, basic Gmail functions  
-- **COMPOSIO_SEARCH**: Web search using any gathered professional details + user name for comprehensive research
-
-## Step-by-Step Process
-1. **Start with Gmail Profile** - Get basic name and email info
-2. **Analyze Email Domain** - Extract company name if not generic provider (gmail, yahoo, outlook, etc.)
-3. **Use GMAIL_SEARCH_PEOPLE** - CRITICAL: Always search using the user's COMPLETE FULL NAME (e.g., "John Smith", "Sarah Johnson") - NEVER use just first name ("John") or partial names. Use the exact full name format from Gmail profile.
-
-4. **Extract PERSONAL Details** - From any professional profiles found via people search:
-   - Their individual background, education, previous experience
-   - Their specific skills, technologies they personally work with
-   - Their personal projects, contributions, achievements
-   - What they personally do, not just company they work for
-5. **Execute COMPOSIO_SEARCH** - Use web search focused on THEM personally:
-   - User's full name + their personal skills/technologies + projects
-   - User's full name + their background + personal achievements
-   - User's full name + personal work, speaking, contributions
-   - Focus on THEM as a person, not company news
-6. **Cross-Verify & Present** - Build profile of THEM personally with verified evidence
-
-## Personality & Tone
-- **Like a friend who's looked you up**: Casual, conversational, naturally curious
-- **Casual confidence**: Present insights naturally, like you've been following them
-- **Contextually aware**: Make observations about why they're here or what they're doing
-- **Lightly cheeky**: Ask engaging questions that show you understand their space/work
-- **Not creepy**: Stay professional and work-focused, avoid personal/private details
-
-## Response Format
-Start with "So you are [Full Name]" then present what you've found about them like you're checking their credentials at the door:
-
-Structure:
-1. **Opening line**: "So you are [Full Name]..." 
-2. **What you found**: Present 2-3 key things about them (job, background, something interesting) in a matter-of-fact way
-3. **Your assessment**: A brief, non-committal observation about what kind of person they seem to be
-4. **The test**: End with something that gauges if they're worth talking to - could be a question, challenge, or comment that sees how they respond
-
-Tone examples:
-- "So you are John Smith, software engineer at TechCorp, been coding for 5 years, recently moved to Austin. Seems like another dev chasing the startup dream. What makes you different from the thousand other engineers I've seen this week?"
-- "So you are Sarah Johnson, marketing director at SaaS company, MBA from Wharton, writes about growth hacking. Another marketing person who thinks they've cracked the code. Prove me wrong."
-
-Keep it real, not hostile - you're just not easily impressed.
-
-## Research Accuracy Rules
-- **USE MULTIPLE SOURCES**: GMAIL_SEARCH_PEOPLE (with COMPLETE FULL NAME) + email domain analysis + web search for comprehensive research
-- Never claim knowledge you can't verify through multiple professional sources
-- **DO NOT** just read email content and make assumptions - get verified professional profile data
-- If multiple people have same name, use LinkedIn profile + email domain to confirm correct identity  
-- Cross-reference: LinkedIn company vs email domain company for consistency
-- Focus on verified professional information from LinkedIn, avoid personal details
-- When uncertain, ask one clarifying question rather than guess
-- Always have 2+ confirming data points from different sources before stating facts
-
-## Privacy Boundaries  
-- Stick to professional, publicly available information from various professional sources
-- **DO NOT reference private email contents** - use verified professional profiles and web sources
-- Focus on verified work info, achievements, company news, industry context from public sources
-- Avoid personal relationships, private activities, or sensitive details from emails
-
-                """
+            # Parallel tool calls in this turn share one concurrency limit
+            with tool_turn():
+                if on_event:
+                    result = await self._stream_graph(graph, state, on_event)
                 else:
-                    # Normal conversation mode
-                    system_content = """
-You are Poke 🌴 — a digital bouncer who has already sized up this person and decided they're worth talking to. You know who they are from your research. Now you're in conversation mode, but you maintain your cool, observant demeanor.
-
-## Your Personality
-You're still the same bouncer - you don't suddenly become eager or overly helpful. You engage because they passed your initial assessment, but you're not trying to win them over. You respond naturally, occasionally referencing what you know about them, but you're not showing off your research.
-
-## Conversation Style
-- Stay cool and measured in your responses
-- Don't repeat all your research - you already made your point
-- Answer their questions or respond to their comments, but don't be overly enthusiastic
-- Reference your knowledge of them only when it's actually relevant to what they're saying
-- Maintain that "I've seen it all" vibe without being dismissive
-
-## Tone Guidelines
-- You're engaged but not eager
-- You're helpful but not desperate to please
-- You remember who they are but don't constantly bring it up
-- You respond with the energy they bring - if they're casual, you're casual; if they're serious, you match that
-- You're confident in your responses because you know who you're talking to
-                """
-                
-                system_message = HumanMessage(content=system_content)
-                messages = [system_message] + state["messages"]
-                return {"messages": [model_with_tools.invoke(messages)]}
-            
-            workflow = StateGraph(MessagesState)
-            workflow.add_node("agent", call_model_with_system)
-            workflow.add_node("tools", tool_node)
-            workflow.add_edge(START, "agent")
-            workflow.add_conditional_edges("agent", tools_condition)
-            workflow.add_edge("tools", "agent")
-            
-            graph = workflow.compile()
-            
-            # Run the graph with automatic research trigger
-            if "Hello Poke" in message or "SYSTEM: Perform initial research" in message:
-                # Trigger automatic research
-                research_prompt = "Research this user automatically using their Gmail profile and web search. Find out who they are, where they work, what they do, and provide insights about them."
-                state = {"messages": [HumanMessage(content=research_prompt)]}
-            else:
-                state = {"messages": [HumanMessage(content=message)]}
-                
-            result = await graph.ainvoke(state)
+                    result = await graph.ainvoke(state, config={"callbacks": self.callbacks})
             
             if result["messages"]:
                 return result["messages"][-1].content
-        else:
-            # No tools - use basic model
-            response = await self.model.ainvoke([HumanMessage(content=message)])
-            return response.content
-            
-        return "I'm here to help!"
+            return "I'm here to help!"
+        
+        # No tools - the basic model, with the same system prompt
+        messages = [SYSTEM_PROMPTS[mode]] + history + [HumanMessage(content=message)]
+        if on_event:
+            content = ""
+            async for chunk in self.model.astream(messages, config={"callbacks": self.callbacks}):
+                if chunk.content:
+                    content += chunk.content
+                    await on_event({"type": "token", "content": chunk.content})
+            return content
+        
+        response = await self.model.ainvoke(messages, config={"callbacks": self.callbacks})
+        return response.content
+    
+    async def _stream_graph(self, graph, state: dict, on_event: Callable[[dict], Awaitable[None]]) -> dict:
+        """Run the graph via astream_events, forwarding tokens and tool calls"""
+        result = {"messages": []}
+        async for event in graph.astream_events(state, version="v2", config={"callbacks": self.callbacks}):
+            kind = event["event"]
+            if kind == "on_chat_model_stream":
+                content = event["data"]["chunk"].content
+                if content and isinstance(content, str):
+                    await on_event({"type": "token", "content": content})
+            elif kind == "on_tool_start":
+                await on_event({"type": "tool_start", "tool": event["name"]})
+            elif kind == "on_tool_end":
+                await on_event({"type": "tool_end", "tool": event["name"]})
+            elif kind == "on_chain_end" and not event["parent_ids"]:
+                # The root run finishing carries the final graph state
+                result = event["data"]["output"]
+        return result
+    
+    def _get_graph(self, user_id: str, tools: list):
+        """Get the compiled graph for a user, rebuilding it when their tool set changes"""
+        fingerprint = tuple(sorted(tool.name for tool in tools))
+        cached = self.graph_cache.get(user_id)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        
+        logger.debug(f"Building graph for user {user_id}")
+        with GRAPH_BUILD.time():
+            graph = self._build_graph(tools)
+        self.graph_cache.set(user_id, (fingerprint, graph))
+        return graph
+    
+    def invalidate_user(self, user_id: str):
+        """Drop cached graphs and tool schemas for a user, e.g. after their connection changes"""
+        self.graph_cache.invalidate(user_id)
+        invalidate_tool_schemas(user_id)
+    
+    def get_cache_stats(self) -> dict:
+        """Get hit/miss counters for the agent's caches"""
+        return {
+            "graphs": self.graph_cache.get_stats(),
+            "tool_schemas": tool_schema_cache.get_stats(),
+            "tool_results": get_tool_result_stats(),
+        }
+    
+    def _build_graph(self, tools: list):
+        """Bind tools to the model and compile the Poke workflow"""
+        # Tool definitions precede the messages in the provider's prompt, so
+        # bind them in a fixed order to keep the cacheable prefix identical.
+        # ToolNode runs the tool calls of one model message concurrently
+        model_with_tools = self.model.bind_tools(sorted(tools, key=lambda tool: tool.name))
+        tool_node = ToolNode(tools)
+        
+        async def call_model_with_system(state):
+            # The mode was picked once for the turn; after a tool round the
+            # last message is a tool result, so it can't be re-detected here
+            messages = [SYSTEM_PROMPTS[state["mode"]]] + state["messages"]
+            return {"messages": [await model_with_tools.ainvoke(messages)]}
+        
+        workflow = StateGraph(PokeState)
+        workflow.add_node("agent", call_model_with_system)
+        workflow.add_node("tools", tool_node)
+        workflow.add_edge(START, "agent")
+        workflow.add_conditional_edges("agent", tools_condition)
+        workflow.add_edge("tools", "agent")
+        
+        return workflow.compile()
     
     async def send_proactive_message(self, user_id: str) -> str:
         """Send a proactive message"""
@@ -1,18 +1,32 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, List, Optional
 import asyncio
+import json
+import os
 
-from .models import User, UserMemory
+from .models import User
 from .message_processor import MessageProcessor
-from .connection import initiate_connection, get_connection_status
-from composio import Composio
-from typing import Dict
-from collections import deque
+from .admission import AdmissionController
+from .history import MAX_CONVERSATION_HISTORY
+from .storage import create_storage
+from .connection import initiate_connection
+from .connection_watcher import ConnectionWatcher
+from .cassette import cassette
+from .game import GamePatchError
+from .lanes import LANES
+from .clients import close_clients
+from .constants import composio
 
 app = FastAPI(title="Poke AI Backend", version="1.0.0")
 
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "true").lower() == "true"
+# Shared by API processes started together, see main.py
+METRICS_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -22,14 +36,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Simple in-memory storage - no Redis needed
-users: Dict[str, User] = {}
-memories: Dict[str, UserMemory] = {}
-message_queue = deque()
+# Users, memories and the message queue; in-memory unless STORAGE_BACKEND=redis
+storage = create_storage()
 
 # Global instances
-message_processor = MessageProcessor(message_queue, users, memories)
-composio_client = Composio()
+message_processor = MessageProcessor(storage)
+admission = AdmissionController(storage)
+# Shared with the agent's tools, so both reuse the same pooled connections
+composio_client = composio
+
+# Longest a status request may wait for a connection to change
+MAX_STATUS_WAIT = 60
+
+
+async def _prewarm(user_id: str):
+    """Queue the research greeting, unless the in-flight limits say we're busy"""
+    try:
+        # Speculative work is the first to shed, and isn't charged to the user's rate
+        if await admission.check(user_id, rate_limited=False) is None:
+            await message_processor.prewarmer.start(user_id)
+    except Exception as e:
+        print(f"Error: {e}")
+
+
+def _on_connection_change(user_id: str, previous: Optional[str], status: str):
+    """React to a connection status change seen by the watcher"""
+    # The user's tools depend on the connection, so drop their cached graph
+    message_processor.agent.invalidate_user(user_id)
+    if status == "ACTIVE":
+        # Start the research greeting before the client asks for it; a
+        # worker runs it, so API processes stay free of agent turns
+        asyncio.create_task(_prewarm(user_id))
+
+
+# Polls Composio once per pending connection, however many clients ask
+connection_watcher = ConnectionWatcher(composio_client, on_change=_on_connection_change)
 
 # Request/Response models
 class UserCreateRequest(BaseModel):
@@ -40,6 +81,21 @@ class UserCreateRequest(BaseModel):
 class MessageRequest(BaseModel):
     user_id: str
     content: str
+    # Retries with the same key get the first message's response
+    idempotency_key: Optional[str] = None
+    # "chat", "game" or "research"; by default game while the user has a game stored
+    mode: Optional[str] = None
+    # The game version a state embedded in content was based on
+    game_version: Optional[int] = None
+
+
+class GameStateRequest(BaseModel):
+    state: dict
+
+
+class GamePatchRequest(BaseModel):
+    # RFC 6902 operations
+    patch: List[Any]
 
 
 class ConnectionRequest(BaseModel):
@@ -50,13 +106,22 @@ class ConnectionRequest(BaseModel):
 @app.on_event("startup")
 async def startup_event():
     """Start the message processor when the API starts"""
-    asyncio.create_task(message_processor.start_processing())
+    # With EMBEDDED_WORKER=false, separate poke-worker processes drain the queue
+    if EMBEDDED_WORKER:
+        asyncio.create_task(message_processor.start_processing())
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Stop the message processor when the API shuts down"""
     await message_processor.stop_processing()
+    await storage.close()
+    await close_clients()
+    if cassette:
+        cassette.close()
+    if METRICS_DIR:
+        # Drops this process's live gauges from the shared totals
+        multiprocess.mark_process_dead(os.getpid())
 
 
 @app.post("/users", response_model=dict)
@@ -68,7 +133,7 @@ async def create_user(request: UserCreateRequest):
             name=request.name
         )
         
-        users[user.connection_id] = user
+        await storage.save_user(user)
         return {"user_id": user.connection_id}
             
     except Exception as e:
@@ -80,12 +145,14 @@ async def create_user(request: UserCreateRequest):
 async def get_user(user_id: str):
     """Get user by ID"""
     try:
-        user = users.get(user_id)
+        user = await storage.get_user(user_id)
         if user:
             return user.model_dump()
         else:
             raise HTTPException(status_code=404, detail="User not found")
             
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
@@ -95,12 +162,18 @@ async def get_user(user_id: str):
 async def initiate_user_connection(request: ConnectionRequest):
     """Initiate Gmail connection for user"""
     try:
-        connected_account = initiate_connection(
+        # The Composio SDK is synchronous, so keep it off the event loop
+        connected_account = await asyncio.to_thread(
+            initiate_connection,
             user_id=request.user_id,
             composio_client=composio_client,
             auth_config_id=request.auth_config_id
         )
         
+        # A new connection changes the user's tools, so drop their cached graph
+        message_processor.agent.invalidate_user(request.user_id)
+        connection_watcher.watch(connected_account.id, request.user_id)
+        
         return {
             "connection_id": connected_account.id,
             "redirect_url": connected_account.redirect_url,
@@ -112,15 +185,15 @@ async def initiate_user_connection(request: ConnectionRequest):
 
 
 @app.get("/connections/{connection_id}/status")
-async def check_connection_status(connection_id: str):
-    """Check connection status"""
+async def check_connection_status(
+    connection_id: str,
+    wait: float = Query(0, ge=0, le=MAX_STATUS_WAIT, description="Seconds to wait for the status to change"),
+    last_status: Optional[str] = Query(None, description="Status the client already has; wait returns once it differs"),
+):
+    """Check connection status, optionally long-polling until it changes"""
     try:
-        status = get_connection_status(
-            connected_account_id=connection_id,
-            composio_client=composio_client
-        )
-        
-        return {"status": status.status, "connection_id": connection_id}
+        status = await connection_watcher.get_status(connection_id, last_status, wait)
+        return {"status": status, "connection_id": connection_id}
         
     except Exception as e:
         print(f"Error: {e}")
@@ -128,16 +201,39 @@ async def check_connection_status(connection_id: str):
 
 
 @app.post("/messages")
-async def send_message(request: MessageRequest):
+async def send_message(
+    request: MessageRequest,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+):
     """Send a message to the agent"""
     try:
         # Check if user exists
-        user = users.get(request.user_id)
+        user = await storage.get_user(request.user_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
+        if request.mode is not None and request.mode not in LANES:
+            raise HTTPException(status_code=422, detail=f"mode must be one of {', '.join(LANES)}")
+        
+        idempotency_key = request.idempotency_key or idempotency_key
+        # Shed load before queueing so queue latency stays bounded; a retry or
+        # duplicate of a message already taken adds no work, so it isn't charged
+        existing_id = await message_processor.find_existing(request.user_id, request.content, idempotency_key)
+        retry_after = None if existing_id else await admission.check(request.user_id)
+        if retry_after is not None:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many messages, please retry later",
+                headers={"Retry-After": str(retry_after)},
+            )
         
         # Queue the message for processing and get message_id
-        message_id = await message_processor.queue_user_message(request.user_id, request.content)
+        message_id = await message_processor.queue_user_message(
+            request.user_id,
+            request.content,
+            idempotency_key=idempotency_key,
+            mode=request.mode,
+            game_version=request.game_version,
+        )
         
         if message_id:
             return {"message_id": message_id, "status": "queued"}
@@ -155,7 +251,7 @@ async def send_message(request: MessageRequest):
 async def get_message_response(message_id: str):
     """Get response for a specific message"""
     try:
-        response_data = message_processor.get_message_response(message_id)
+        response_data = await message_processor.get_message_response(message_id)
         if response_data.get("status") == "not_found":
             raise HTTPException(status_code=404, detail="Message not found")
         return response_data
@@ -166,13 +262,58 @@ async def get_message_response(message_id: str):
         raise HTTPException(status_code=500, detail="Failed to get message response")
 
 
+@app.get("/messages/{message_id}/stream")
+async def stream_message_response(message_id: str):
+    """Stream tokens and tool progress for a message as server-sent events"""
+    if (await message_processor.get_message_response(message_id)).get("status") == "not_found":
+        raise HTTPException(status_code=404, detail="Message not found")
+    
+    async def event_source():
+        async for event in message_processor.stream_message_events(message_id):
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    """Whether the client's If-None-Match already names this version"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def _cache_headers(etag: str) -> dict:
+    # no-cache makes browsers revalidate with If-None-Match on every poll
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
 @app.get("/users/{user_id}/memory")
-async def get_user_memory(user_id: str):
+async def get_user_memory(
+    user_id: str,
+    request: Request,
+    response: Response,
+    since: Optional[int] = Query(None, ge=0, description="Only include turns after this cursor"),
+):
     """Get user memory and insights"""
     try:
-        if user_id not in memories:
-            memories[user_id] = UserMemory(user_id=user_id)
-        return memories[user_id].model_dump()
+        memory = await storage.get_user_memory(user_id)
+        etag = f'"{memory.turn_count}-{memory.summary_through}"'
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=_cache_headers(etag))
+        
+        data = memory.model_dump()
+        if since is not None:
+            # turn_count doubles as the cursor for the next delta request
+            first = memory.turn_count - len(memory.conversation_history)
+            data["conversation_history"] = memory.conversation_history[max(0, since - first):]
+        response.headers.update(_cache_headers(etag))
+        return data
         
     except Exception as e:
         print(f"Error: {e}")
@@ -180,18 +321,129 @@ async def get_user_memory(user_id: str):
 
 
 @app.get("/users/{user_id}/conversations")
-async def get_user_conversations(user_id: str):
-    """Get user conversation history"""
+async def get_user_conversations(
+    user_id: str,
+    request: Request,
+    response: Response,
+    since: Optional[int] = Query(None, ge=0, description="Cursor from a previous response; only later turns are returned"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_CONVERSATION_HISTORY),
+):
+    """Get user conversation history, a page or only the turns after a cursor"""
     try:
-        if user_id not in memories:
-            memories[user_id] = UserMemory(user_id=user_id)
-        return {"conversations": memories[user_id].conversation_history}
+        # The turn count changes with every append, so it versions the history
+        turn_count = await storage.get_turn_count(user_id)
+        etag = f'"{turn_count}"'
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=_cache_headers(etag))
+        
+        if since is None:
+            # Without a cursor, limit picks the most recent turns
+            since = max(0, turn_count - limit) if limit else 0
+        turns, start, turn_count = await storage.get_conversation_page(user_id, since, limit)
+        response.headers.update(_cache_headers(f'"{turn_count}"'))
+        return {
+            "conversations": turns,
+            "since": start,
+            "cursor": start + len(turns),
+            "total": turn_count,
+            "has_more": start + len(turns) < turn_count,
+        }
         
     except Exception as e:
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail="Unable to retrieve conversations")
 
 
+def _expected_version(if_match: Optional[str]) -> Optional[int]:
+    """The game version named by an If-Match header, if any"""
+    if not if_match or if_match.strip() == "*":
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match must name a game version")
+
+
+@app.get("/users/{user_id}/game")
+async def get_game_state(user_id: str, request: Request, response: Response):
+    """Get the user's authoritative game state"""
+    state, version = await storage.get_game_state(user_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="No game in progress")
+    etag = f'"{version}"'
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=_cache_headers(etag))
+    response.headers.update(_cache_headers(etag))
+    return {"state": state, "version": version}
+
+
+@app.put("/users/{user_id}/game")
+async def put_game_state(
+    user_id: str,
+    request: GameStateRequest,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+):
+    """Start or replace the user's game state"""
+    try:
+        version = await message_processor.games.save(user_id, request.state, _expected_version(if_match))
+    except GamePatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if version is None:
+        raise HTTPException(status_code=412, detail="Game state has changed")
+    response.headers["ETag"] = f'"{version}"'
+    return {"version": version}
+
+
+@app.patch("/users/{user_id}/game")
+async def patch_game_state(
+    user_id: str,
+    request: GamePatchRequest,
+    response: Response,
+    if_match: Optional[str] = Header(None),
+):
+    """Apply a JSON Patch to the user's game state"""
+    try:
+        version = await message_processor.games.patch(user_id, request.patch, _expected_version(if_match))
+    except GamePatchError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if version is None:
+        raise HTTPException(status_code=412, detail="Game state has changed")
+    response.headers["ETag"] = f'"{version}"'
+    return {"version": version}
+
+
+@app.delete("/users/{user_id}/game")
+async def delete_game_state(user_id: str):
+    """End the user's game, so their messages go back to chat"""
+    if not await message_processor.games.end(user_id):
+        raise HTTPException(status_code=404, detail="No game in progress")
+    return {"status": "ended"}
+
+
+@app.get("/processor/stats")
+async def get_processor_stats():
+    """Get message queue depth and worker utilisation"""
+    stats = await message_processor.get_stats()
+    stats["admission"] = admission.get_stats()
+    stats["connections"] = connection_watcher.get_stats()
+    return stats
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: stage latencies, tokens and tool calls
+
+    Covers every API process when they share PROMETHEUS_MULTIPROC_DIR
+    (poke-server --workers N sets it), otherwise just this one.
+    """
+    if not METRICS_DIR:
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -0,0 +1,398 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult, LLMResult
+from langchain_core.tools import StructuredTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+logger = logging.getLogger(__name__)
+
+# off, record (capture live traffic) or replay (serve it back, no network)
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off")
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "poke-cassette.jsonl.gz")
+# Replayed calls sleep their recorded duration times this; 0 replays instantly
+CASSETTE_TIME_SCALE = float(os.getenv("CASSETTE_TIME_SCALE", "1.0"))
+
+
+class CassetteMiss(LookupError):
+    """A replayed server made a call the cassette has no recording for"""
+
+
+def _open(path: str, mode: str):
+    # Gzipped JSON lines, unless the path says otherwise
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _process_path(path: str) -> str:
+    """Where this process records: path with the pid before its extensions"""
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    return os.path.join(directory, f"{stem}.{os.getpid()}{dot}{extensions}")
+
+
+def _cassette_files(path: str) -> List[str]:
+    """The cassette at path and every per-process recording made for it"""
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    pattern = re.compile(rf"{re.escape(stem)}\.\d+{re.escape(dot + extensions)}")
+    files = [path] if os.path.exists(path) else []
+    files += sorted(
+        os.path.join(directory, entry) for entry in os.listdir(directory or ".") if pattern.fullmatch(entry)
+    )
+    if not files:
+        raise FileNotFoundError(f"No cassette at {path}")
+    return files
+
+
+def _lines(cassette):
+    """Lines of a cassette, stopping quietly where a killed recorder cut it short"""
+    try:
+        for line in cassette:
+            if line.endswith("\n"):
+                yield line
+    except EOFError:
+        logger.warning("Cassette ends mid-record; replaying what was written")
+
+
+def _message_key(messages: Sequence[BaseMessage]) -> str:
+    """Identify a model request by its messages, ignoring ids that differ between runs"""
+    parts = [
+        (
+            message.type,
+            message.content,
+            [(call["name"], call["args"]) for call in getattr(message, "tool_calls", None) or []],
+        )
+        for message in messages
+    ]
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _turn_key(messages: Sequence[BaseMessage]) -> str:
+    """Identify a model request by the user message it answers and its tool round
+
+    Survives changes to prompts and context, so a changed server can still
+    be replayed when the exact request no longer matches.
+    """
+    human = max((i for i, message in enumerate(messages) if isinstance(message, HumanMessage)), default=-1)
+    rounds = sum(1 for message in messages[human + 1:] if isinstance(message, AIMessage))
+    content = messages[human].content if human >= 0 else ""
+    return hashlib.sha1(json.dumps([content, rounds], default=str).encode()).hexdigest()
+
+
+def _tool_key(user_id: str, tool_name: str, arguments: str) -> str:
+    return f"{user_id}\x00{tool_name}\x00{arguments}"
+
+
+def _not_replayed(**kwargs):
+    raise CassetteMiss("Replayed tools only run through get_cached_google_tools")
+
+
+class Recording:
+    """One recorded call, consumable once"""
+
+    __slots__ = ("seconds", "data", "used")
+
+    def __init__(self, seconds: float, data: Any):
+        self.seconds = seconds
+        self.data = data
+        self.used = False
+
+
+class Cassette:
+    """Captures model calls, tool calls and incoming messages, or serves them back
+
+    Each line of the file is one JSON record: "message" (a user message and
+    when it arrived), "schemas" (a user's tool definitions), "llm" (a model
+    request's keys, the reply and its duration) or "tool" (a tool result
+    and its duration).
+
+    Each recording process appends to its own file, named after path with
+    its pid, so workers never interleave writes in one gzip stream. Replay
+    merges path and all of those files.
+    """
+
+    def __init__(self, path: str = CASSETTE_PATH, mode: str = CASSETTE_MODE, time_scale: float = CASSETTE_TIME_SCALE):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.time_scale = time_scale
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        # Requests matched by turn because the exact request changed
+        self.fallbacks = 0
+        # Arrival times count from the first recorded message
+        self._started: Optional[float] = None
+        self._lock = threading.Lock()
+        self._file = None
+        # Replay indexes
+        self.messages: List[Tuple[float, str, str]] = []
+        self._schemas: Dict[str, List[dict]] = {}
+        self._llm_by_request: Dict[str, deque] = defaultdict(deque)
+        self._llm_by_turn: Dict[str, deque] = defaultdict(deque)
+        self._tools: Dict[str, deque] = defaultdict(deque)
+        self._last_tools: Dict[str, Recording] = {}
+
+        if mode == "record":
+            self.path = _process_path(path)
+            self._file = _open(self.path, "a")
+        else:
+            self._load()
+
+    def _load(self) -> None:
+        files = _cassette_files(self.path)
+        messages = []
+        for path in files:
+            with _open(path, "r") as cassette:
+                self._load_file(cassette, messages)
+        # Each process counts "at" from its own first message, so align
+        # the processes on the wall clock when every record has it
+        if all("wall" in record for record in messages):
+            started = min((record["wall"] for record in messages), default=0.0)
+            self.messages = [(record["wall"] - started, record["user_id"], record["content"]) for record in messages]
+        else:
+            self.messages = [(record["at"], record["user_id"], record["content"]) for record in messages]
+        self.messages.sort()
+        logger.info(f"Loaded cassette {self.path} from {len(files)} files: {len(self.messages)} messages")
+
+    def _load_file(self, cassette, messages: list) -> None:
+        """Index one file's recordings, collecting its message records into messages"""
+        for line in _lines(cassette):
+            record = json.loads(line)
+            kind = record["type"]
+            if kind == "message":
+                messages.append(record)
+            elif kind == "schemas":
+                self._schemas[record["user_id"]] = record["tools"]
+            elif kind == "llm":
+                recording = Recording(record["seconds"], record["reply"])
+                self._llm_by_request[record["request"]].append(recording)
+                self._llm_by_turn[record["turn"]].append(recording)
+            elif kind == "tool":
+                key = _tool_key(record["user_id"], record["tool"], record["arguments"])
+                self._tools[key].append(Recording(record["seconds"], record["result"]))
+
+    def _write(self, record: dict) -> None:
+        line = json.dumps(record, separators=(",", ":"), default=str)
+        # Tool calls record from the tool thread pool
+        with self._lock:
+            self._file.write(line + "\n")
+            # Flushed per record, so a killed process leaves a readable cassette
+            self._file.flush()
+            self.recorded += 1
+
+    # Recording
+
+    def record_message(self, user_id: str, content: str) -> None:
+        if self._started is None:
+            self._started = time.monotonic()
+        self._write({
+            "type": "message",
+            "at": round(time.monotonic() - self._started, 3),
+            "wall": round(time.time(), 3),
+            "user_id": user_id,
+            "content": content,
+        })
+
+    def record_schemas(self, user_id: str, tools: list) -> None:
+        self._write({
+            "type": "schemas",
+            "user_id": user_id,
+            "tools": [convert_to_openai_tool(tool)["function"] for tool in tools],
+        })
+
+    def record_llm(self, messages: Sequence[BaseMessage], reply: BaseMessage, seconds: float) -> None:
+        self._write({
+            "type": "llm",
+            "request": _message_key(messages),
+            "turn": _turn_key(messages),
+            "seconds": round(seconds, 4),
+            "reply": {
+                "content": reply.content,
+                "tool_calls": getattr(reply, "tool_calls", None) or [],
+                "usage": getattr(reply, "usage_metadata", None),
+            },
+        })
+
+    def record_tool(self, user_id: str, tool_name: str, arguments: str, result: Any, seconds: float) -> None:
+        self._write({
+            "type": "tool",
+            "user_id": user_id,
+            "tool": tool_name,
+            "arguments": arguments,
+            "seconds": round(seconds, 4),
+            "result": result,
+        })
+
+    # Replay
+
+    @staticmethod
+    def _take(queue: deque) -> Optional[Recording]:
+        """Pop the oldest recording not already served through another index"""
+        while queue:
+            recording = queue.popleft()
+            if not recording.used:
+                recording.used = True
+                return recording
+        return None
+
+    def _miss(self, what: str) -> CassetteMiss:
+        self.misses += 1
+        return CassetteMiss(f"No recording for {what} in {self.path}")
+
+    async def _sleep(self, recording: Recording) -> None:
+        self.replayed += 1
+        if self.time_scale:
+            await asyncio.sleep(recording.seconds * self.time_scale)
+
+    def tools(self, user_id: str) -> list:
+        """Recorded tool definitions for a user; get_cached_google_tools routes their calls to tool_result"""
+        definitions = self._schemas.get(user_id)
+        if definitions is None:
+            raise self._miss(f"tool schemas of user {user_id}")
+        return [
+            StructuredTool(
+                name=definition["name"],
+                description=definition.get("description", ""),
+                args_schema=definition.get("parameters") or {"type": "object", "properties": {}},
+                func=_not_replayed,
+            )
+            for definition in definitions
+        ]
+
+    async def tool_result(self, user_id: str, tool_name: str, arguments: str) -> Any:
+        """The recorded result of a tool call
+
+        Repeats of a call beyond those recorded reuse its last result, since
+        the replayed server may cache differently than the recorded one did.
+        """
+        key = _tool_key(user_id, tool_name, arguments)
+        recording = self._take(self._tools[key]) or self._last_tools.get(key)
+        if recording is None:
+            raise self._miss(f"{tool_name}({arguments}) for user {user_id}")
+        self._last_tools[key] = recording
+        await self._sleep(recording)
+        return recording.data
+
+    async def llm_reply(self, messages: Sequence[BaseMessage]) -> AIMessage:
+        """The recorded reply to this request, or to the same turn and round"""
+        recording = self._take(self._llm_by_request[_message_key(messages)])
+        if recording is None:
+            recording = self._take(self._llm_by_turn[_turn_key(messages)])
+            if recording is None:
+                raise self._miss("a model request")
+            self.fallbacks += 1
+        await self._sleep(recording)
+        reply = recording.data
+        return AIMessage(content=reply["content"], tool_calls=reply["tool_calls"], usage_metadata=reply["usage"])
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def get_stats(self) -> dict:
+        """Get how many records were written or served, and replay misses"""
+        return {
+            "mode": self.mode,
+            "path": self.path,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "fallbacks": self.fallbacks,
+            "misses": self.misses,
+        }
+
+
+class CassetteRecorder(BaseCallbackHandler):
+    """Writes every chat model call in a run to the cassette"""
+
+    run_inline = True
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        # run_id -> (request messages, start time)
+        self._started: Dict[UUID, tuple] = {}
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages, *, run_id: UUID, **kwargs: Any) -> None:
+        self._started[run_id] = (messages[0], time.perf_counter())
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._started.pop(run_id, None)
+        if started is None:
+            return
+        messages, started_at = started
+        self.cassette.record_llm(messages, response.generations[0][0].message, time.perf_counter() - started_at)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._started.pop(run_id, None)
+
+
+class ReplayChatModel(BaseChatModel):
+    """Chat model that answers from a cassette instead of calling OpenAI"""
+
+    cassette: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "poke-replay"
+
+    def bind_tools(self, tools, **kwargs):
+        # The recorded replies already carry their tool calls
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        # For sync callers off the event loop; the replayed delay is an
+        # asyncio sleep, so run the async path on this thread's own loop
+        return asyncio.run(self._agenerate(messages, stop=stop, **kwargs))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=await self.cassette.llm_reply(messages))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        reply = await self.cassette.llm_reply(messages)
+        if reply.tool_calls or not reply.content:
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=reply.content,
+                usage_metadata=reply.usage_metadata,
+                tool_call_chunks=[
+                    {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": n}
+                    for n, call in enumerate(reply.tool_calls)
+                ],
+            ))
+            return
+        # The recording keeps only the total time, so tokens follow it at once
+        words = reply.content.split(" ")
+        for n, word in enumerate(words):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if n == len(words) - 1 else word + " "))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=reply.usage_metadata))
+
+
+def _open_cassette() -> Optional[Cassette]:
+    if CASSETTE_MODE == "off":
+        return None
+    cassette = Cassette()
+    logger.info(f"Cassette {cassette.mode} mode: {cassette.path}")
+    return cassette
+
+
+# The process-wide cassette selected by CASSETTE_MODE, or None
+cassette = _open_cassette()
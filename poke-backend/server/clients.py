@@ -0,0 +1,51 @@
+import os
+
+import httpx
+
+# Pool limits shared by every upstream client
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+# Per-call read timeouts; model calls stream for a while, Composio calls shouldn't
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+COMPOSIO_TIMEOUT = int(os.getenv("COMPOSIO_TIMEOUT", "30"))
+
+
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package (pip install httpx[http2])"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+HTTP2 = _http2_available()
+
+
+def _client_options(read_timeout: float) -> dict:
+    return {
+        "http2": HTTP2,
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(read_timeout, connect=HTTP_CONNECT_TIMEOUT),
+    }
+
+
+# Long-lived pools, so requests reuse warm connections instead of paying for
+# a new TLS handshake each time. The Composio SDK only accepts a sync client;
+# its calls run in worker threads
+openai_async_http = httpx.AsyncClient(**_client_options(OPENAI_TIMEOUT))
+openai_http = httpx.Client(**_client_options(OPENAI_TIMEOUT))
+composio_http = httpx.Client(**_client_options(COMPOSIO_TIMEOUT))
+
+
+async def close_clients() -> None:
+    """Close the shared pools; call once at shutdown"""
+    await openai_async_http.aclose()
+    openai_http.close()
+    composio_http.close()
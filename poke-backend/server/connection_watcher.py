@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+from typing import Callable, Optional
+
+from composio import Composio
+
+from .cache import TTLCache
+from .connection import get_connection_status
+
+logger = logging.getLogger(__name__)
+
+# Composio statuses after which a connection stops changing on its own
+TERMINAL_STATUSES = {"ACTIVE", "FAILED", "EXPIRED", "INACTIVE"}
+
+CONNECTION_POLL_MIN_INTERVAL = float(os.getenv("CONNECTION_POLL_MIN_INTERVAL", "1"))
+CONNECTION_POLL_MAX_INTERVAL = float(os.getenv("CONNECTION_POLL_MAX_INTERVAL", "5"))
+# Give up on a connection the user never authorises after this long
+CONNECTION_WATCH_TIMEOUT = float(os.getenv("CONNECTION_WATCH_TIMEOUT", "600"))
+CONNECTION_CACHE_TTL = float(os.getenv("CONNECTION_CACHE_TTL", "3600"))
+
+
+class WatchedConnection:
+    """Last known status of a connection, and the event its waiters sleep on"""
+
+    __slots__ = ("user_id", "status", "changed", "task")
+
+    def __init__(self, user_id: Optional[str], status: Optional[str]):
+        self.user_id = user_id
+        self.status = status
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+
+class ConnectionWatcher:
+    """Polls Composio once per pending connection, however many clients ask
+
+    Each pending connection gets one background poller that backs off
+    between checks. Status requests are answered from the cached status,
+    and long-polling requests wake as soon as the poller sees a change.
+    """
+
+    def __init__(
+        self,
+        composio_client: Composio,
+        on_change: Optional[Callable[[str, Optional[str], str], None]] = None,
+    ):
+        self.composio_client = composio_client
+        # Called with (user_id, previous status, new status)
+        self.on_change = on_change
+        self.connections = TTLCache(max_size=10_000, ttl=CONNECTION_CACHE_TTL)
+        self.upstream_polls = 0
+        self.status_requests = 0
+
+    def watch(self, connection_id: str, user_id: Optional[str], status: Optional[str] = None) -> WatchedConnection:
+        """Track a connection, polling it in the background until it settles"""
+        entry = self.connections.get(connection_id)
+        if entry is None:
+            entry = WatchedConnection(user_id, status)
+            self.connections.set(connection_id, entry)
+        elif user_id:
+            entry.user_id = user_id
+
+        if entry.status not in TERMINAL_STATUSES and (entry.task is None or entry.task.done()):
+            entry.task = asyncio.create_task(self._poll(connection_id, entry))
+        return entry
+
+    async def _fetch_status(self, connection_id: str) -> str:
+        # The Composio SDK is synchronous, so keep it off the event loop
+        status = await asyncio.to_thread(
+            get_connection_status,
+            connected_account_id=connection_id,
+            composio_client=self.composio_client,
+        )
+        self.upstream_polls += 1
+        return status.status
+
+    async def _poll(self, connection_id: str, entry: WatchedConnection):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CONNECTION_WATCH_TIMEOUT
+        interval = CONNECTION_POLL_MIN_INTERVAL
+        while loop.time() < deadline:
+            try:
+                status = await self._fetch_status(connection_id)
+                if status != entry.status:
+                    self._update(entry, status)
+                    interval = CONNECTION_POLL_MIN_INTERVAL
+                if status in TERMINAL_STATUSES:
+                    return
+            except Exception as e:
+                logger.error(f"Error polling connection {connection_id}: {type(e).__name__}")
+                logger.debug(f"Full error details: {e}")
+
+            await asyncio.sleep(interval)
+            interval = min(interval * 1.5, CONNECTION_POLL_MAX_INTERVAL)
+        logger.info(f"Stopped watching connection {connection_id} after {CONNECTION_WATCH_TIMEOUT:g}s")
+        # Nothing refreshes a pending status any more, so drop it and let the
+        # next request fetch it again and restart the watch
+        if self.connections.get(connection_id) is entry:
+            self.connections.invalidate(connection_id)
+
+    def _update(self, entry: WatchedConnection, status: str):
+        previous, entry.status = entry.status, status
+        # Wake every long-poll waiting on the old status
+        entry.changed.set()
+        entry.changed = asyncio.Event()
+        if self.on_change and entry.user_id:
+            self.on_change(entry.user_id, previous, status)
+
+    async def get_status(self, connection_id: str, last_status: Optional[str] = None, wait: float = 0) -> str:
+        """Get a connection's status, waiting up to wait seconds while it still equals last_status"""
+        self.status_requests += 1
+
+        async def load():
+            # Not started here (another process, or before a restart), so
+            # check once and keep watching if it's still pending
+            status = await self._fetch_status(connection_id)
+            return self.watch(connection_id, None, status)
+
+        entry = self.connections.get(connection_id) or await self.connections.get_or_load(connection_id, load)
+        if wait and entry.status == last_status:
+            try:
+                await asyncio.wait_for(entry.changed.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        return entry.status
+
+    def get_stats(self) -> dict:
+        """Get how many connections are tracked and how many upstream polls they cost"""
+        return {
+            "tracked": len(self.connections),
+            "upstream_polls": self.upstream_polls,
+            "status_requests": self.status_requests,
+        }
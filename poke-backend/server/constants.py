@@ -7,12 +7,22 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
+from .clients import COMPOSIO_TIMEOUT, OPENAI_TIMEOUT, composio_http, openai_async_http, openai_http
+
+# One client of each per process, sharing the pooled connections in clients.py
 composio = Composio(
     api_key=os.getenv("COMPOSIO_API_KEY"),
     provider=LangchainProvider(),
+    http_client=composio_http,
+    timeout=COMPOSIO_TIMEOUT,
 )
 
 openai = ChatOpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
-    model='gpt-5'
+    model='gpt-5',
+    # Token usage on streamed responses too, for the per-call metrics
+    stream_usage=True,
+    http_client=openai_http,
+    http_async_client=openai_async_http,
+    timeout=OPENAI_TIMEOUT,
 )
\ No newline at end of file
@@ -0,0 +1,121 @@
+import os
+from typing import List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from .metrics import llm_metrics
+from .models import UserMemory
+
+# Tokens of history (summary plus verbatim turns) sent with each message
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+# Turns that must fall out of the verbatim window before they are folded
+# into the summary, so the summariser runs every few turns, not every turn
+SUMMARY_BATCH_TURNS = int(os.getenv("SUMMARY_BATCH_TURNS", "6"))
+# gpt-5 counts its reasoning against max_tokens, so the summary call gets
+# this much on top of the summary's own length
+SUMMARY_REASONING_TOKENS = 1024
+
+SUMMARY_PROMPT = f"""You maintain a running summary of a conversation between a user and Poke, an AI assistant.
+Update the current summary with the new turns. Keep facts about the user, decisions, open questions and anything Poke promised to do.
+Drop small talk. Write plain prose in under {SUMMARY_MAX_TOKENS * 3 // 4} words."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, about four characters per token for English"""
+    return len(text) // 4 + 1
+
+
+class ContextBuilder:
+    """Fits a user's conversation history into a token budget for the next turn
+
+    Recent turns are sent verbatim, newest first, until the budget runs out.
+    Older turns are folded into a rolling summary a batch at a time, so each
+    turn is summarised once and the prompt stays bounded.
+    """
+
+    def __init__(
+        self,
+        model,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        summary_max_tokens: int = SUMMARY_MAX_TOKENS,
+        batch_turns: int = SUMMARY_BATCH_TURNS,
+        callbacks: Optional[list] = None,
+    ):
+        self.model = model
+        self.callbacks = callbacks or [llm_metrics]
+        self.token_budget = token_budget
+        self.summary_max_tokens = summary_max_tokens
+        self.batch_turns = batch_turns
+        self.builds = 0
+        self.summaries = 0
+        self.history_tokens = 0
+
+    def _split(self, memory: UserMemory) -> Tuple[int, int, int]:
+        """Get the absolute index of history[0], the number of leading
+        entries already summarised and the index where verbatim turns start"""
+        history = memory.conversation_history
+        # turn_count counts every turn ever stored; history keeps the newest
+        offset = max(memory.turn_count, len(history)) - len(history)
+        summarised = min(len(history), max(0, memory.summary_through - offset))
+
+        budget = self.token_budget - (estimate_tokens(memory.summary) if memory.summary else 0)
+        start = len(history)
+        while start > summarised:
+            cost = estimate_tokens(history[start - 1]["message"] or "")
+            if cost > budget:
+                break
+            budget -= cost
+            start -= 1
+        return offset, summarised, start
+
+    def build(self, memory: UserMemory) -> List[BaseMessage]:
+        """Messages to put before the user's new message"""
+        _, _, start = self._split(memory)
+        messages: List[BaseMessage] = []
+        if memory.summary:
+            messages.append(SystemMessage(content=f"Summary of the earlier conversation:\n{memory.summary}"))
+        for turn in memory.conversation_history[start:]:
+            message_class = HumanMessage if turn["type"] == "user" else AIMessage
+            messages.append(message_class(content=turn["message"] or ""))
+
+        self.builds += 1
+        self.history_tokens += sum(estimate_tokens(message.content) for message in messages)
+        return messages
+
+    async def update_summary(self, memory: UserMemory) -> Optional[Tuple[str, int]]:
+        """Fold turns that have left the verbatim window into the summary
+
+        Returns the new (summary, summary_through), or None if fewer than
+        batch_turns turns are waiting or the model returned no summary.
+        """
+        offset, summarised, start = self._split(memory)
+        if start - summarised < self.batch_turns:
+            return None
+
+        transcript = "\n".join(
+            f"{'User' if turn['type'] == 'user' else 'Poke'}: {turn['message']}"
+            for turn in memory.conversation_history[summarised:start]
+        )
+        response = await self.model.bind(
+            max_tokens=self.summary_max_tokens + SUMMARY_REASONING_TOKENS,
+            reasoning_effort="low",
+        ).ainvoke([
+            SystemMessage(content=SUMMARY_PROMPT),
+            HumanMessage(content=f"Current summary:\n{memory.summary or '(none)'}\n\nNew turns:\n{transcript}"),
+        ], config={"callbacks": self.callbacks})
+        if not response.content:
+            # Out of tokens before any text; keep the old summary and retry
+            # these turns with the next batch
+            return None
+        self.summaries += 1
+        return response.content, offset + start
+
+    def get_stats(self) -> dict:
+        """Get how many contexts and summaries were built, and their average size"""
+        return {
+            "token_budget": self.token_budget,
+            "builds": self.builds,
+            "summaries": self.summaries,
+            "avg_history_tokens": self.history_tokens / self.builds if self.builds else 0.0,
+        }
@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import re
+from typing import Any, Dict, Optional, Tuple
+
+import jsonpatch
+
+from .storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Introduces the game state, both embedded by bridges and in the model prompt
+GAME_MARKER = "Current Game State"
+# Top-level fields always sent to the model, however unrelated the action looks
+GAME_ALWAYS_KEYS = {
+    key.strip() for key in os.getenv("GAME_ALWAYS_KEYS", "player,location,status").split(",") if key.strip()
+}
+# States up to this size are sent whole; slicing them saves nothing
+GAME_SLICE_MIN_BYTES = int(os.getenv("GAME_SLICE_MIN_BYTES", "1500"))
+GAME_MAX_PATCH_OPS = int(os.getenv("GAME_MAX_PATCH_OPS", "50"))
+GAME_MAX_STATE_BYTES = int(os.getenv("GAME_MAX_STATE_BYTES", "65536"))
+
+PATCH_BLOCK = re.compile(r"```json-patch\s*(.*?)```", re.S)
+# Full states, from models still following the old instructions
+STATE_BLOCK = re.compile(r"```json\s*(.*?)```", re.S)
+
+
+class GamePatchError(ValueError):
+    """A patch that is malformed or would leave an invalid game state"""
+
+
+def _check_state(state: Any) -> dict:
+    if not isinstance(state, dict):
+        raise GamePatchError("Game state must be a JSON object")
+    if len(json.dumps(state)) > GAME_MAX_STATE_BYTES:
+        raise GamePatchError(f"Game state is larger than {GAME_MAX_STATE_BYTES} bytes")
+    return state
+
+
+def apply_patch(state: dict, patch: Any) -> dict:
+    """Apply an RFC 6902 JSON Patch to a copy of state, validating both"""
+    if not isinstance(patch, list) or not all(isinstance(op, dict) for op in patch):
+        raise GamePatchError("A patch must be a list of operations")
+    if len(patch) > GAME_MAX_PATCH_OPS:
+        raise GamePatchError(f"A patch may have at most {GAME_MAX_PATCH_OPS} operations")
+    try:
+        return _check_state(jsonpatch.apply_patch(state, patch))
+    except (jsonpatch.JsonPatchException, jsonpatch.JsonPointerException, TypeError, KeyError) as e:
+        raise GamePatchError(f"Invalid patch: {e}") from e
+
+
+def extract_state(content: str) -> Tuple[Optional[dict], str]:
+    """Split a message into the game state it embeds, if any, and the rest"""
+    marker = content.find(GAME_MARKER)
+    start = content.find("{", marker) if marker >= 0 else -1
+    if start < 0:
+        return None, content
+    try:
+        state, end = json.JSONDecoder().raw_decode(content, start)
+    except json.JSONDecodeError:
+        return None, content
+    if not isinstance(state, dict):
+        return None, content
+    return state, (content[:marker] + content[end:]).strip()
+
+
+def _mentioned(key: str, action: str) -> bool:
+    words = key.lower().replace("_", " ")
+    return words in action or words.rstrip("s") in action
+
+
+def _describe(value: Any) -> str:
+    if isinstance(value, list):
+        return f"list of {len(value)}"
+    return f"object with {len(value)} keys"
+
+
+def slice_state(state: dict, action: str) -> Tuple[dict, Dict[str, str]]:
+    """The fields the model needs for an action, and short descriptions of the rest
+
+    Scalars are always kept; collections only when the action mentions them
+    or they are in GAME_ALWAYS_KEYS.
+    """
+    if len(json.dumps(state)) <= GAME_SLICE_MIN_BYTES:
+        return state, {}
+    action = action.lower()
+    relevant, omitted = {}, {}
+    for key, value in state.items():
+        if not isinstance(value, (dict, list)) or key in GAME_ALWAYS_KEYS or _mentioned(key, action):
+            relevant[key] = value
+        else:
+            omitted[key] = _describe(value)
+    return relevant, omitted
+
+
+def parse_reply(reply: str) -> Tuple[str, Optional[Any], Optional[Any]]:
+    """Split a game reply into its narration, JSON patch and full state, stripping both blocks"""
+    patch = state = None
+    match = PATCH_BLOCK.search(reply)
+    if match:
+        reply = reply[:match.start()] + reply[match.end():]
+        try:
+            patch = json.loads(match.group(1))
+        except json.JSONDecodeError:
+            patch = match.group(1)
+    else:
+        match = STATE_BLOCK.search(reply)
+        if match:
+            try:
+                state = json.loads(match.group(1))
+                reply = reply[:match.start()] + reply[match.end():]
+            except json.JSONDecodeError:
+                pass
+    return reply.strip(), patch, state
+
+
+class GameStore:
+    """Keeps each user's game state server-side for Game Mode
+
+    The model sees only the slice of state relevant to the player's action
+    and answers with a JSON Patch, which is validated and applied here.
+    Bridges that still embed the whole state in each message keep working.
+    The embedded copy starts a new game, or replaces the stored one when the
+    client names the version it edited; otherwise the stored state wins.
+    Such a game stays bridge-driven: only messages embedding a state are
+    game turns, so the bridge returns to chat just by not sending one.
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        self.turns = 0
+        self.patches = 0
+        self.full_states = 0
+        self.rejected = 0
+        self.conflicts = 0
+        self.stale_states = 0
+        self.prompt_bytes = 0
+        self.state_bytes = 0
+
+    async def in_progress(self, user_id: str) -> bool:
+        """Whether the user has a stored game the server drives, so plain messages are game turns"""
+        state, _ = await self.storage.get_game_state(user_id)
+        return state is not None and not await self.storage.is_bridged_game(user_id)
+
+    async def prepare(self, user_id: str, content: str, sent_version: Optional[int] = None) -> Tuple[str, str]:
+        """Build the model prompt for a game message; returns (prompt, player action)
+
+        sent_version is the game version the client's embedded state was based on, if it said.
+        """
+        sent_state, action = extract_state(content)
+        state, version = await self.storage.get_game_state(user_id)
+        if sent_state is not None and sent_state != state:
+            saved = None
+            if state is None or sent_version == version:
+                saved = await self.storage.save_game_state(
+                    user_id, _check_state(sent_state), expected_version=version, bridged=True
+                )
+            if saved is None:
+                # A copy from before the server's last change, e.g. a bridge
+                # that missed a reply's patch; the stored state wins
+                self.stale_states += 1
+                logger.info(f"Ignored a stale embedded game state for user {user_id}")
+            else:
+                state, version = sent_state, saved
+        if state is None:
+            return content, content
+
+        relevant, omitted = slice_state(state, action)
+        prompt = (
+            f"{GAME_MARKER} (version {version}"
+            f"{', only the fields relevant to this action' if omitted else ''}):\n"
+            f"{json.dumps(relevant, separators=(',', ':'))}\n"
+        )
+        if omitted:
+            prompt += "Other fields, unchanged unless you patch them: " + ", ".join(
+                f"{key} ({description})" for key, description in omitted.items()
+            ) + "\n"
+        prompt += f"\nPlayer action:\n{action}"
+
+        self.turns += 1
+        self.prompt_bytes += len(prompt)
+        self.state_bytes += len(json.dumps(state))
+        return prompt, action
+
+    async def apply_reply(self, user_id: str, reply: str) -> Tuple[str, Optional[dict]]:
+        """Apply the state change in a game reply; returns the narration and
+        {"version", "patch"} (or {"version", "error"}), or None if nothing changed"""
+        text, patch, full_state = parse_reply(reply)
+        if patch is None and full_state is None:
+            return text, None
+
+        # Patches are deltas, so one that lost a race is re-applied to the newer state
+        for _ in range(3):
+            state, version = await self.storage.get_game_state(user_id)
+            try:
+                if patch is not None:
+                    new_state = apply_patch(state or {}, patch)
+                else:
+                    new_state = _check_state(full_state)
+                    patch = [{"op": "replace", "path": "", "value": new_state}]
+            except GamePatchError as e:
+                self.rejected += 1
+                logger.warning(f"Rejected game patch for user {user_id}: {e}")
+                return text, {"version": version, "error": str(e)}
+
+            new_version = await self.storage.save_game_state(user_id, new_state, expected_version=version)
+            if new_version is not None:
+                if full_state is None:
+                    self.patches += 1
+                else:
+                    self.full_states += 1
+                return text, {"version": new_version, "patch": patch}
+            self.conflicts += 1
+
+        return text, {"version": version, "error": "Game state kept changing; patch not applied"}
+
+    async def save(self, user_id: str, state: Any, expected_version: Optional[int] = None) -> Optional[int]:
+        """Replace the user's state, e.g. when a game starts; None on a version conflict"""
+        return await self.storage.save_game_state(user_id, _check_state(state), expected_version, bridged=False)
+
+    async def end(self, user_id: str) -> bool:
+        """Delete the user's state, so their messages go back to chat; False if there was none"""
+        return await self.storage.delete_game_state(user_id)
+
+    async def patch(self, user_id: str, patch: Any, expected_version: Optional[int] = None) -> Optional[int]:
+        """Apply a client's patch to the user's state; None on a version conflict"""
+        state, version = await self.storage.get_game_state(user_id)
+        if expected_version is not None and expected_version != version:
+            return None
+        return await self.storage.save_game_state(user_id, apply_patch(state or {}, patch), version)
+
+    def get_stats(self) -> dict:
+        """Get game turn counters and how much of the state prompts carried"""
+        return {
+            "turns": self.turns,
+            "patches": self.patches,
+            "full_states": self.full_states,
+            "rejected": self.rejected,
+            "conflicts": self.conflicts,
+            "stale_states": self.stale_states,
+            "prompt_to_state_ratio": self.prompt_bytes / self.state_bytes if self.state_bytes else None,
+        }
@@ -0,0 +1,74 @@
+import time
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+MAX_CONVERSATION_HISTORY = 50
+
+
+class ConversationTurn:
+    """One stored message; the timestamp is microseconds since the epoch"""
+
+    __slots__ = ("message", "type", "timestamp")
+
+    def __init__(self, message: str, message_type: str, timestamp: int):
+        self.message = message
+        self.type = message_type
+        self.timestamp = timestamp
+
+    def to_dict(self) -> dict:
+        """Serialise to the dict shape the API has always returned"""
+        return {
+            "message": self.message,
+            "type": self.type,
+            "timestamp": datetime.fromtimestamp(self.timestamp / 1_000_000).isoformat(),
+        }
+
+
+class ConversationHistory:
+    """Fixed-capacity ring buffer of a user's most recent turns
+
+    The backing list grows until it reaches capacity, then new turns
+    overwrite the oldest in place, so appending never copies the history.
+    """
+
+    __slots__ = ("_turns", "_start", "capacity", "turn_count")
+
+    def __init__(self, capacity: int = MAX_CONVERSATION_HISTORY):
+        self._turns: List[ConversationTurn] = []
+        self._start = 0
+        self.capacity = capacity
+        # Turns ever appended, including ones since overwritten
+        self.turn_count = 0
+
+    def append(self, message: str, message_type: str) -> None:
+        turn = ConversationTurn(message, message_type, time.time_ns() // 1000)
+        if len(self._turns) < self.capacity:
+            self._turns.append(turn)
+        else:
+            self._turns[self._start] = turn
+            self._start = (self._start + 1) % self.capacity
+        self.turn_count += 1
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def __iter__(self) -> Iterator[ConversationTurn]:
+        """Iterate from oldest to newest"""
+        turns = self._turns
+        for i in range(len(turns)):
+            yield turns[(self._start + i) % len(turns)]
+
+    def to_list(self) -> List[dict]:
+        return [turn.to_dict() for turn in self]
+
+    def page(self, since: int, limit: Optional[int] = None) -> Tuple[List[dict], int]:
+        """Serialise turns from absolute index since, returning them with the
+        index of the first one (later than since if older turns were dropped)"""
+        first = self.turn_count - len(self._turns)
+        start = min(max(since, first), self.turn_count)
+        stop = self.turn_count if limit is None else min(self.turn_count, start + limit)
+        turns = self._turns
+        return [
+            turns[(self._start + index - first) % len(turns)].to_dict()
+            for index in range(start, stop)
+        ], start
@@ -0,0 +1,102 @@
+import os
+import re
+from collections import deque
+from typing import Dict, List
+
+# Priority classes, highest first
+CHAT = "chat"
+GAME = "game"
+RESEARCH = "research"
+LANES = (CHAT, GAME, RESEARCH)
+
+
+def _parse_weights(spec: str) -> Dict[str, int]:
+    """Parse "chat=6,game=3,research=1" into lane weights"""
+    weights = {CHAT: 6, GAME: 3, RESEARCH: 1}
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        lane, _, weight = part.partition("=")
+        if lane in weights:
+            weights[lane] = max(1, int(weight))
+    return weights
+
+
+LANE_WEIGHTS = _parse_weights(os.getenv("LANE_WEIGHTS", ""))
+# Workers per process allowed on research at once; 0 means half the pool
+RESEARCH_MAX_WORKERS = int(os.getenv("RESEARCH_MAX_WORKERS", "0"))
+LATENCY_SAMPLES = 1000
+
+
+# Substrings that select each mode, checked in this order; anything else is
+# chat. Game Mode needs an embedded state or a stored game rather than a
+# substring, see MessageProcessor._classify
+MODE_MARKERS = (
+    (RESEARCH, ("Hello Poke", "SYSTEM: Perform initial research", "Research this user automatically")),
+)
+_MODE_PATTERNS = [(lane, re.compile("|".join(map(re.escape, markers)))) for lane, markers in MODE_MARKERS]
+
+
+def classify_message(content: str) -> str:
+    """Pick the lane for a message, which is also the mode PokeAgent runs it in
+
+    Called once per message when it is queued; the lane travels with it.
+    """
+    for lane, pattern in _MODE_PATTERNS:
+        if pattern.search(content):
+            return lane
+    return CHAT
+
+
+class LaneScheduler:
+    """Smooth weighted round robin over the lanes that currently have room"""
+
+    def __init__(self, weights: Dict[str, int] = LANE_WEIGHTS):
+        self.weights = weights
+        self.total = sum(weights.values())
+        self.credit = {lane: 0 for lane in weights}
+
+    def order(self, lanes=LANES) -> List[str]:
+        """Lanes in the order a worker should try them"""
+        return sorted(lanes, key=lambda lane: self.credit[lane] + self.weights[lane], reverse=True)
+
+    def served(self, lane: str) -> None:
+        """Charge a lane for the message a worker just took from it"""
+        for other in self.credit:
+            # Clamp so an idle lane can't bank enough credit to starve the rest
+            self.credit[other] = min(self.total, self.credit[other] + self.weights[other])
+        self.credit[lane] = max(-self.total, self.credit[lane] - self.total)
+
+
+class LaneLatency:
+    """Recent queue wait and total latency samples for one lane"""
+
+    __slots__ = ("count", "waits", "totals")
+
+    def __init__(self):
+        self.count = 0
+        self.waits = deque(maxlen=LATENCY_SAMPLES)
+        self.totals = deque(maxlen=LATENCY_SAMPLES)
+
+    def record(self, wait: float, total: float) -> None:
+        self.count += 1
+        self.waits.append(wait)
+        self.totals.append(total)
+
+    @staticmethod
+    def _percentiles(samples) -> dict:
+        if not samples:
+            return {"p50": None, "p95": None, "max": None}
+        ordered = sorted(samples)
+        last = len(ordered) - 1
+        return {
+            "p50": round(ordered[int(last * 0.5)], 3),
+            "p95": round(ordered[int(last * 0.95)], 3),
+            "max": round(ordered[-1], 3),
+        }
+
+    def get_stats(self) -> dict:
+        """Get percentiles, in seconds, over the recent samples"""
+        return {
+            "count": self.count,
+            "queue_wait": self._percentiles(self.waits),
+            "total": self._percentiles(self.totals),
+        }
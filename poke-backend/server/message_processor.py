@@ -1,105 +1,431 @@
 import asyncio
-from typing import Optional
+import hashlib
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 import logging
+from collections import deque
 from .agent import PokeAgent
-from .models import Message, User
+from .cassette import cassette
+from .context import ContextBuilder
+from .game import GameStore, extract_state
+from .lanes import CHAT, GAME, LANES, RESEARCH, RESEARCH_MAX_WORKERS, LaneLatency, LaneScheduler, classify_message
+from .metrics import COALESCED, QUEUE_WAIT, TURN_SECONDS, WORKERS_BUSY, llm_metrics
+from .models import Message
+from .prewarm import PREWARM_MESSAGE_TYPE, ResearchPrewarmer
+from .response_store import RESPONSE_TTL
+from .storage import Storage
+from .tools import get_tool_stats
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_NUM_WORKERS = int(os.getenv("MESSAGE_WORKERS", "4"))
+# An identical message from the same user within this many seconds, while the
+# first is still queued or running, shares its result (0 disables). Off by
+# default, since a user may well mean to send the same thing twice
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0"))
+# How long a client-supplied idempotency key maps to its message
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", str(RESPONSE_TTL)))
+
+
 class MessageProcessor:
-    def __init__(self, message_queue, users, memories):
+    def __init__(self, storage: Storage, num_workers: Optional[int] = None):
         self.agent = PokeAgent()
-        self.message_queue = message_queue
-        self.users = users
-        self.memories = memories
+        self.context = ContextBuilder(self.agent.model, callbacks=self.agent.callbacks)
+        self.prewarmer = ResearchPrewarmer(self.agent, storage)
+        self.games = GameStore(storage)
+        self.storage = storage
         self.processing = False
-        self.message_responses = {}  # Track responses by message_id
+        self.num_workers = max(1, num_workers or DEFAULT_NUM_WORKERS)
+        self.active_workers = 0
+        # Messages waiting behind an in-flight message from the same user in
+        # the same lane, keyed by (user_id, lane) like RedisStorage.user_turn
+        self.user_backlogs: Dict[Tuple[str, str], deque] = {}
+        # The message each of those owning workers is on
+        self.user_running: Dict[Tuple[str, str], Message] = {}
+        self._workers = []
+        # Weighted fair choice between lanes, so long research turns can't
+        # starve chat replies; research is also capped to part of the pool
+        self.scheduler = LaneScheduler()
+        self.research_max_workers = RESEARCH_MAX_WORKERS or max(1, self.num_workers // 2)
+        self.lane_workers = {lane: 0 for lane in LANES}
+        self.lane_latency = {lane: LaneLatency() for lane in LANES}
+        self.coalesced = 0
+        # At most one summary per user at a time, run outside the user's turn
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
     
     async def start_processing(self):
-        """Start the message processing loop"""
+        """Start the pool of message processing workers"""
         self.processing = True
-        logger.info("Starting message processor...")
+        logger.info(f"Starting message processor with {self.num_workers} workers...")
+        
+        self._workers = [
+            asyncio.create_task(self._worker_loop(worker_id))
+            for worker_id in range(self.num_workers)
+        ]
+        await asyncio.gather(*self._workers, return_exceptions=True)
+    
+    async def stop_processing(self):
+        """Stop the message processing workers"""
+        self.processing = False
+        logger.info("Stopping message processor...")
         
+        # Workers idle in storage.dequeue(), so wake them by cancelling
+        for worker in self._workers:
+            worker.cancel()
+        # Unsummarised turns stay pending and are picked up after the next message
+        for task in list(self._summary_tasks.values()):
+            task.cancel()
+    
+    async def _worker_loop(self, worker_id: int):
+        """Pull messages off the shared queue until processing stops"""
         while self.processing:
             try:
-                # Get next message from queue
-                try:
-                    message = self.message_queue.pop()
-                except IndexError:
-                    message = None
-                
-                if message:
-                    await self._process_message(message)
-                else:
-                    # No messages, wait
-                    await asyncio.sleep(1)
-                    
+                # Sleeps until queue_user_message puts something on a queue
+                message = await self.storage.dequeue(self._lane_order)
+                self.scheduler.served(message.lane)
+                await self._process_user_messages(message)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                logger.error(f"Error in message processing loop: {type(e).__name__}")
+                logger.error(f"Error in message worker {worker_id}: {type(e).__name__}")
                 # Log full error for debugging in development
                 logger.debug(f"Full error details: {e}")
-                await asyncio.sleep(5)
+                # Back off briefly so a storage outage doesn't spin the loop
+                await asyncio.sleep(1)
     
-    async def stop_processing(self):
-        """Stop the message processing loop"""
-        self.processing = False
-        logger.info("Stopping message processor...")
+    def _lane_order(self) -> List[str]:
+        """Lanes with room for another worker, in weighted fair order"""
+        lanes = LANES
+        if self.lane_workers[RESEARCH] >= self.research_max_workers:
+            lanes = [lane for lane in LANES if lane != RESEARCH]
+        return self.scheduler.order(lanes)
+    
+    async def _process_user_messages(self, message: Message):
+        """Process a message, then drain anything queued behind it for the same user and lane"""
+        # Order is kept per lane, so research can't hold up the same user's chat
+        key = (message.user_id, message.lane)
+        if key in self.user_backlogs:
+            running = self.user_running[key]
+            if 0 < message.sequence < running.sequence:
+                # An earlier message reclaimed from a dead worker; the owner
+                # is waiting for it in user_turn, so run it now
+                self.active_workers += 1
+                try:
+                    await self._run_turn(message)
+                finally:
+                    self.active_workers -= 1
+                return
+            # Another worker owns this user's lane; it runs the message once
+            # the earlier ones finish so per-user ordering is preserved
+            self.user_backlogs[key].append(message)
+            return
+        
+        self.user_backlogs[key] = deque()
+        self.active_workers += 1
+        try:
+            while message:
+                self.user_running[key] = message
+                await self._run_turn(message)
+                backlog = self.user_backlogs[key]
+                message = backlog.popleft() if backlog else None
+        finally:
+            self.active_workers -= 1
+            del self.user_backlogs[key]
+            del self.user_running[key]
+    
+    async def _run_turn(self, message: Message):
+        self.lane_workers[message.lane] += 1
+        WORKERS_BUSY.labels(message.lane).inc()
+        try:
+            # Other worker processes may hold messages for this user too
+            async with self.storage.user_turn(message):
+                await self._process_message(message)
+        finally:
+            self.lane_workers[message.lane] -= 1
+            WORKERS_BUSY.labels(message.lane).dec()
+    
+    async def get_stats(self) -> dict:
+        """Get queue depth, worker utilisation and per-lane latency"""
+        backlog_depth = sum(len(backlog) for backlog in self.user_backlogs.values())
+        lane_depths = await self.storage.lane_depths()
+        return {
+            "queue_depth": sum(lane_depths.values()) + backlog_depth,
+            "active_workers": self.active_workers,
+            "num_workers": self.num_workers,
+            "active_users": len({user_id for user_id, _ in self.user_backlogs}),
+            "lanes": {
+                lane: {
+                    "queued": lane_depths[lane],
+                    "running": self.lane_workers[lane],
+                    "weight": self.scheduler.weights[lane],
+                    **self.lane_latency[lane].get_stats(),
+                }
+                for lane in LANES
+            },
+            "responses": await self.storage.get_response_stats(),
+            "caches": self.agent.get_cache_stats(),
+            "context": self.context.get_stats(),
+            "tools": get_tool_stats(),
+            "llm": llm_metrics.get_stats(),
+            "prewarm": self.prewarmer.get_stats(),
+            "game": self.games.get_stats(),
+            "coalesced": self.coalesced,
+            "cassette": cassette.get_stats() if cassette else None,
+        }
     
     async def _process_message(self, message: Message):
         """Process a single message"""
+        started_at = time.time()
+        status = "error"
         try:
-            logger.info(f"Processing message {message.message_id} from user {message.user_id}")
+            logger.info(f"Processing message {message.message_id} from user {message.user_id} ({message.lane})")
+            
+            if message.message_type == PREWARM_MESSAGE_TYPE:
+                # Nobody polls a speculative turn; its result waits in storage
+                await self.prewarmer.run(message.user_id)
+                status = "completed"
+                return
             
-            # Process through agent
-            response = await self.agent.process_message(message.user_id, message.content)
+            # The research greeting may already have run when the connection went active
+            response = None
+            if message.lane == RESEARCH:
+                response = await self.prewarmer.take(message.user_id)
+            
+            # Game state lives server-side; the model sees the relevant slice
+            prompt, user_turn = message.content, message.content
+            if message.lane == GAME:
+                prompt, user_turn = await self.games.prepare(message.user_id, message.content, message.game_version)
+            
+            if response is None:
+                # Recent turns plus the rolling summary, within the token budget
+                memory = await self.storage.get_user_memory(message.user_id)
+                
+                # Process through agent, streaming tokens and tool progress
+                response = await self.agent.process_message(
+                    message.user_id,
+                    prompt,
+                    on_event=lambda event: self.storage.publish_event(message.message_id, event),
+                    history=self.context.build(memory),
+                    mode=message.lane,
+                )
+            
+            # Apply the reply's state patch and keep only the narration
+            game = None
+            if message.lane == GAME:
+                response, game = await self.games.apply_reply(message.user_id, response)
             
             # Store the response mapped to message_id
-            self.message_responses[message.message_id] = {
+            response_data = {
                 "response": response,
                 "timestamp": __import__('datetime').datetime.now().isoformat(),
                 "status": "completed"
             }
+            if game is not None:
+                response_data["game"] = game
+            await self.storage.set_response(message.message_id, response_data)
+            await self._finish_events(message.message_id, response_data)
             
             # Store the conversation for history
-            self._add_conversation(message.user_id, message.content, "user")
-            self._add_conversation(message.user_id, response, "agent")
+            await self.storage.add_conversations(
+                message.user_id,
+                [(user_turn, "user"), (response, "agent")],
+            )
             
             logger.info(f"Generated response for message {message.message_id}: {response[:100]}...")
             
+            # Summarise in the background, so neither this worker nor the
+            # user's next message waits on it
+            self._schedule_summary(message.user_id)
+            status = "completed"
+            
+        except asyncio.CancelledError:
+            # Shutting down mid-turn: leave the message unacknowledged and in
+            # flight, so a worker reclaims it and runs it again
+            status = "cancelled"
+            raise
         except Exception as e:
             logger.error(f"Error processing message {message.message_id}: {type(e).__name__}")
             # Store error response
-            self.message_responses[message.message_id] = {
+            response_data = {
                 "response": "Sorry, I encountered an error processing your message.",
                 "timestamp": __import__('datetime').datetime.now().isoformat(),
                 "status": "error"
             }
+            await self.storage.set_response(message.message_id, response_data)
+            await self._finish_events(message.message_id, response_data)
             logger.debug(f"Full error details: {e}")
+        finally:
+            # Only acknowledge once handled, so a crash leaves it to be reclaimed
+            if status != "cancelled":
+                await self.storage.ack(message)
+                await self.storage.track_in_flight(message.user_id, -1)
+            finished_at = time.time()
+            TURN_SECONDS.labels(message.lane, status).observe(finished_at - started_at)
+            if message.queued_at:
+                QUEUE_WAIT.labels(message.lane).observe(started_at - message.queued_at)
+                self.lane_latency[message.lane].record(
+                    started_at - message.queued_at, finished_at - message.queued_at
+                )
     
+    def _schedule_summary(self, user_id: str):
+        """Start a background summary for the user unless one is already running"""
+        if user_id in self._summary_tasks:
+            return
+        task = asyncio.create_task(self._update_summary(user_id))
+        self._summary_tasks[user_id] = task
+        task.add_done_callback(lambda _: self._summary_tasks.pop(user_id, None))
     
-    async def queue_user_message(self, user_id: str, content: str) -> str:
-        """Queue a user message for processing and return message_id"""
+    async def _update_summary(self, user_id: str):
+        """Fold turns that left the context window into the user's rolling summary"""
+        try:
+            memory = await self.storage.get_user_memory(user_id)
+            updated = await self.context.update_summary(memory)
+            if updated:
+                await self.storage.save_summary(user_id, *updated)
+        except Exception as e:
+            # The turns stay pending and are retried after the next message
+            logger.error(f"Error summarising conversation for user {user_id}: {type(e).__name__}")
+            logger.debug(f"Full error details: {e}")
+    
+    async def _finish_events(self, message_id: str, response_data: dict):
+        """Send the final event that ends a message's stream"""
+        await self.storage.publish_event(message_id, {
+            "type": "done",
+            "status": response_data["status"],
+            "response": response_data["response"],
+        })
+    
+    async def stream_message_events(self, message_id: str) -> AsyncIterator[dict]:
+        """Yield a message's streaming events until its final "done" event"""
+        response_data = await self.get_message_response(message_id)
+        # A coalesced message streams the events of the one it attached to
+        source_id = response_data.get("coalesced_into", message_id)
+        if response_data["status"] != "processing":
+            # Already finished, so there is nothing left to stream
+            yield {
+                "type": "done",
+                "status": response_data["status"],
+                "response": response_data.get("response"),
+            }
+            return
+        
+        async for event in self.storage.subscribe_events(source_id):
+            yield event
+            if event["type"] == "done":
+                await self.storage.mark_response_fetched(message_id)
+    
+    @staticmethod
+    def _dedup_key(user_id: str, content: str, idempotency_key: Optional[str]) -> Optional[tuple]:
+        """Get the (key, ttl, attachable statuses) a message is deduplicated by, if any"""
+        if idempotency_key:
+            # The client vouches these are the same message, finished or not
+            return f"{user_id}:key:{idempotency_key}", IDEMPOTENCY_TTL, ("processing", "completed", "error")
+        if COALESCE_WINDOW > 0:
+            key = f"{user_id}:content:{hashlib.sha256(content.encode()).hexdigest()}"
+            return key, COALESCE_WINDOW, ("processing",)
+        return None
+    
+    async def _attachable(self, message_id: Optional[str], attachable: tuple) -> bool:
+        existing = await self.storage.get_response(message_id) if message_id else None
+        return bool(existing) and existing["status"] in attachable
+    
+    async def find_existing(self, user_id: str, content: str, idempotency_key: Optional[str] = None) -> Optional[str]:
+        """Get the message a new one would be attached to, without claiming its dedup key"""
+        dedup = self._dedup_key(user_id, content, idempotency_key)
+        if dedup is None:
+            return None
+        key, _, attachable = dedup
+        existing_id = await self.storage.get_message_key(key)
+        return existing_id if await self._attachable(existing_id, attachable) else None
+    
+    async def _attach_to_existing(
+        self, user_id: str, content: str, message_id: str, idempotency_key: Optional[str]
+    ) -> Optional[str]:
+        """Claim the message's dedup key, or return the identical message already holding it"""
+        dedup = self._dedup_key(user_id, content, idempotency_key)
+        if dedup is None:
+            return None
+        key, ttl, attachable = dedup
+        
+        existing_id = await self.storage.claim_message_key(key, message_id, ttl)
+        if existing_id is None:
+            return None
+        if await self._attachable(existing_id, attachable):
+            return existing_id
+        # The earlier message finished or expired, so this one runs afresh
+        await self.storage.claim_message_key(key, message_id, ttl, replace=True)
+        return None
+    
+    async def _classify(self, user_id: str, content: str) -> str:
+        """Pick a message's lane: game for an embedded state or while the
+        server drives the user's game, research by its markers"""
+        # A bridge embeds the state in every game message, the first included
+        if extract_state(content)[0] is not None:
+            return GAME
+        lane = classify_message(content)
+        if lane == CHAT and await self.games.in_progress(user_id):
+            return GAME
+        return lane
+    
+    async def queue_user_message(
+        self,
+        user_id: str,
+        content: str,
+        idempotency_key: Optional[str] = None,
+        mode: Optional[str] = None,
+        game_version: Optional[int] = None,
+    ) -> str:
+        """Queue a user message for processing and return message_id
+
+        A duplicate of a message still in flight (or one sent with the same
+        idempotency key) isn't run again; its message_id resolves to the
+        original's response. mode picks the lane instead of _classify, and
+        game_version is the version an embedded game state was based on.
+        """
         try:
             import uuid
             message_id = str(uuid.uuid4())
             
+            if cassette and cassette.mode == "record":
+                # Incoming traffic too, so a replay can send the same messages
+                cassette.record_message(user_id, content)
+            
+            # Mark as processing before claiming the dedup key, so a duplicate
+            # that finds the key always finds this message in flight
+            await self.storage.set_response(message_id, {
+                "response": None,
+                "timestamp": __import__('datetime').datetime.now().isoformat(),
+                "status": "processing"
+            })
+            
+            existing_id = await self._attach_to_existing(user_id, content, message_id, idempotency_key)
+            if existing_id:
+                await self.storage.set_response(message_id, {
+                    "response": None,
+                    "timestamp": __import__('datetime').datetime.now().isoformat(),
+                    "status": "coalesced",
+                    "coalesced_into": existing_id,
+                })
+                self.coalesced += 1
+                COALESCED.inc()
+                logger.info(f"Coalesced message {message_id} from user {user_id} into {existing_id}")
+                return message_id
+            
             message = Message(
                 user_id=user_id,
                 content=content,
                 message_type="user",
-                message_id=message_id
+                message_id=message_id,
+                lane=mode or await self._classify(user_id, content),
+                queued_at=time.time(),
+                game_version=game_version,
             )
             
-            # Mark as processing
-            self.message_responses[message_id] = {
-                "response": None,
-                "timestamp": __import__('datetime').datetime.now().isoformat(),
-                "status": "processing"
-            }
-            
-            self.message_queue.appendleft(message)
+            await self.storage.enqueue(message)
+            await self.storage.track_in_flight(user_id, 1)
             return message_id
             
         except Exception as e:
@@ -107,24 +433,15 @@ class MessageProcessor:
             logger.debug(f"Full error details: {e}")
             return ""
     
-    def get_message_response(self, message_id: str) -> dict:
+    async def get_message_response(self, message_id: str) -> dict:
         """Get response for a specific message_id"""
-        return self.message_responses.get(message_id, {"status": "not_found"})
-    
-    def _add_conversation(self, user_id: str, message: str, message_type: str) -> bool:
-        """Add conversation to user memory"""
-        if user_id not in self.memories:
-            from .models import UserMemory
-            self.memories[user_id] = UserMemory(user_id=user_id)
-        
-        self.memories[user_id].conversation_history.append({
-            "message": message,
-            "type": message_type,
-            "timestamp": __import__('datetime').datetime.now().isoformat()
-        })
-        
-        # Keep only last 50 conversations
-        if len(self.memories[user_id].conversation_history) > 50:
-            self.memories[user_id].conversation_history = self.memories[user_id].conversation_history[-50:]
-        
-        return True
\ No newline at end of file
+        response_data = await self.storage.get_response(message_id) or {"status": "not_found"}
+        if response_data["status"] == "coalesced":
+            existing_id = response_data["coalesced_into"]
+            response_data = await self.storage.get_response(existing_id) or {"status": "not_found"}
+            response_data["coalesced_into"] = existing_id
+        if response_data["status"] in ("completed", "error"):
+            # The client has its answer, so the entry can be evicted early;
+            # a coalesced message leaves the original for its own client
+            await self.storage.mark_response_fetched(message_id)
+        return response_data
@@ -0,0 +1,135 @@
+import time
+from collections import defaultdict
+from typing import Any, Dict, Optional, Set
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from prometheus_client import Counter, Gauge, Histogram
+
+# Seconds; queue waits are short when healthy, model turns run to minutes
+FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+QUEUE_WAIT = Histogram(
+    "poke_queue_wait_seconds", "Time a message waited in the queue", ["lane"], buckets=FAST_BUCKETS
+)
+TURN_SECONDS = Histogram(
+    "poke_turn_seconds", "Time to handle a message once dequeued", ["lane", "status"], buckets=SLOW_BUCKETS
+)
+# Summed over the live processes when several API processes share /metrics
+WORKERS_BUSY = Gauge("poke_workers_busy", "Workers handling a message", ["lane"], multiprocess_mode="livesum")
+TOOL_SCHEMA_FETCH = Histogram(
+    "poke_tool_schema_fetch_seconds", "Time to fetch a user's tool schemas from Composio", buckets=FAST_BUCKETS
+)
+GRAPH_BUILD = Histogram(
+    "poke_graph_build_seconds", "Time to bind tools and compile a user's agent graph", buckets=FAST_BUCKETS
+)
+LLM_CALL = Histogram(
+    "poke_llm_call_seconds", "Duration of each chat model call", ["model", "status"], buckets=SLOW_BUCKETS
+)
+LLM_TOKENS = Histogram(
+    "poke_llm_tokens", "Tokens per chat model call", ["model", "kind"], buckets=TOKEN_BUCKETS
+)
+LLM_FIRST_TOKEN = Histogram(
+    "poke_llm_first_token_seconds", "Time from a streamed chat model call to its first chunk", ["model"], buckets=FAST_BUCKETS
+)
+TOOL_CALL = Histogram(
+    "poke_tool_call_seconds", "Duration of each tool call", ["tool", "outcome"], buckets=SLOW_BUCKETS
+)
+COALESCED = Counter("poke_messages_coalesced_total", "Messages attached to an identical one in flight")
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Times every chat model call in a run and records its token usage
+
+    Passed in a run's config, so it sees agent, streaming and summary calls alike.
+    Input tokens served from the provider's prompt cache are counted per model,
+    so get_stats can report the cache hit rate.
+    """
+
+    # Called on the event loop rather than in an executor; it only does arithmetic
+    run_inline = True
+
+    def __init__(self):
+        # run_id -> (model name, start time)
+        self._started: Dict[UUID, tuple] = {}
+        # Streamed runs that have produced their first chunk
+        self._first_token: Set[UUID] = set()
+        # model -> [calls, input tokens, cached input tokens]
+        self._tokens: Dict[str, list] = defaultdict(lambda: [0, 0, 0])
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages, *, run_id: UUID, **kwargs: Any) -> None:
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model") or params.get("model_name") or params.get("_type") or "unknown"
+        self._started[run_id] = (model, time.perf_counter())
+
+    def on_llm_new_token(self, token, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._started.get(run_id)
+        if started is None or run_id in self._first_token:
+            return
+        self._first_token.add(run_id)
+        model, started_at = started
+        LLM_FIRST_TOKEN.labels(model).observe(time.perf_counter() - started_at)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._started.pop(run_id, None)
+        self._first_token.discard(run_id)
+        if started is None:
+            return
+        model, started_at = started
+        LLM_CALL.labels(model, "ok").observe(time.perf_counter() - started_at)
+
+        usage = _usage(response)
+        if usage:
+            cached = (usage.get("input_token_details") or {}).get("cache_read", 0)
+            LLM_TOKENS.labels(model, "input").observe(usage.get("input_tokens", 0))
+            LLM_TOKENS.labels(model, "cached").observe(cached)
+            LLM_TOKENS.labels(model, "output").observe(usage.get("output_tokens", 0))
+            totals = self._tokens[model]
+            totals[0] += 1
+            totals[1] += usage.get("input_tokens", 0)
+            totals[2] += cached
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._started.pop(run_id, None)
+        self._first_token.discard(run_id)
+        if started is not None:
+            model, started_at = started
+            LLM_CALL.labels(model, "error").observe(time.perf_counter() - started_at)
+
+    def get_stats(self) -> dict:
+        """Get input tokens per model and the share served from the prompt cache"""
+        return {
+            model: {
+                "calls": calls,
+                "input_tokens": input_tokens,
+                "cached_tokens": cached,
+                "cache_hit_rate": cached / input_tokens if input_tokens else None,
+            }
+            for model, (calls, input_tokens, cached) in self._tokens.items()
+        }
+
+
+def _usage(response: LLMResult) -> Optional[dict]:
+    """Token usage from the generated message, or the provider's llm_output"""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage
+    token_usage = (response.llm_output or {}).get("token_usage")
+    if token_usage:
+        return {
+            "input_tokens": token_usage.get("prompt_tokens", 0),
+            "output_tokens": token_usage.get("completion_tokens", 0),
+            "input_token_details": {
+                "cache_read": (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+            },
+        }
+    return None
+
+
+# Keyed by run_id and model, so one instance serves every run
+llm_metrics = LLMMetricsCallback()
@@ -6,16 +6,24 @@ from datetime import datetime
 class User(BaseModel):
     connection_id: str
     name: Optional[str] = None
+    email: Optional[str] = None
 
 
 class Message(BaseModel):
     user_id: str
     content: str
-    message_type: str  # "user", "agent", "system"
+    message_type: str  # "user", "agent", "system", "prewarm"
     timestamp: datetime = datetime.now()
     message_id: str = ""
+    sequence: int = 0  # Per-user order, assigned when queued
+    lane: str = "chat"  # Priority class, see lanes.py
+    queued_at: float = 0.0  # Unix time the message was queued
+    game_version: Optional[int] = None  # Game version an embedded state was based on
 
 
 class UserMemory(BaseModel):
     user_id: str
-    conversation_history: list = []
\ No newline at end of file
+    conversation_history: list = []
+    summary: str = ""  # Rolling summary of turns older than the context window
+    summary_through: int = 0  # Turns (counted from the first ever) covered by summary
+    turn_count: int = 0  # Turns ever stored, including ones trimmed from history
\ No newline at end of file
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Optional
+
+from .lanes import RESEARCH
+from .models import Message
+from .storage import Storage
+
+logger = logging.getLogger(__name__)
+
+PREWARM_ENABLED = os.getenv("PREWARM_RESEARCH", "true").lower() == "true"
+# How long a speculative result waits for the user's "Hello Poke"
+PREWARM_TTL = float(os.getenv("PREWARM_TTL", "600"))
+# Stored results outlive the TTL briefly, so expiry can tell whether one was claimed
+EXPIRY_GRACE = 60
+
+# Any research trigger works; PokeAgent swaps it for the research prompt
+RESEARCH_TRIGGER = "SYSTEM: Perform initial research"
+# Marks queued speculative turns, which store their result instead of a response
+PREWARM_MESSAGE_TYPE = "prewarm"
+
+
+class ResearchPrewarmer:
+    """Starts the research greeting as soon as a user's Gmail connection is ACTIVE
+
+    The client sends "Hello Poke" only after it sees the connection go
+    active, so the research turn can usually finish before it arrives. The
+    speculative turn is queued on the research lane like any other, so it
+    runs on the worker pool within the research cap. The user's own research
+    message queues behind it and claims the stored result.
+    """
+
+    def __init__(self, agent, storage: Storage, ttl: float = PREWARM_TTL, enabled: bool = PREWARM_ENABLED):
+        self.agent = agent
+        self.storage = storage
+        self.ttl = ttl
+        self.enabled = enabled
+        self.started = 0
+        self.hits = 0
+        self.failed = 0
+        self.wasted = 0
+
+    async def start(self, user_id: str) -> bool:
+        """Queue research for a user unless a process already queued it within the TTL"""
+        if not self.enabled:
+            return False
+        message_id = f"prewarm-{uuid.uuid4()}"
+        # The same dedup keys queue_user_message uses, so one start wins across processes
+        if await self.storage.claim_message_key(f"{user_id}:prewarm", message_id, self.ttl) is not None:
+            return False
+        await self.storage.enqueue(Message(
+            user_id=user_id,
+            content=RESEARCH_TRIGGER,
+            message_type=PREWARM_MESSAGE_TYPE,
+            message_id=message_id,
+            lane=RESEARCH,
+            queued_at=time.time(),
+        ))
+        await self.storage.track_in_flight(user_id, 1)
+        self.started += 1
+        logger.info(f"Pre-warming research for user {user_id}")
+        return True
+
+    async def run(self, user_id: str) -> None:
+        """Run a queued speculative research turn and store its result for take()"""
+        try:
+            response = await self.agent.process_message(user_id, RESEARCH_TRIGGER)
+            # Stored so a worker in another process can claim it too
+            await self.storage.save_prewarm(user_id, response, self.ttl + EXPIRY_GRACE)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error pre-warming research for user {user_id}: {type(e).__name__}")
+            logger.debug(f"Full error details: {e}")
+            return
+
+        asyncio.get_running_loop().call_later(
+            self.ttl, lambda: asyncio.create_task(self._expire(user_id))
+        )
+
+    async def _expire(self, user_id: str) -> None:
+        # Still stored means no worker, here or in another process, claimed it
+        if await self.storage.take_prewarm(user_id) is not None:
+            self.wasted += 1
+
+    async def take(self, user_id: str) -> Optional[str]:
+        """Claim the user's speculative research result
+
+        A pre-warm still queued or running was queued earlier on the same
+        lane, so user_turn ordering has already let it finish.
+        """
+        response = await self.storage.take_prewarm(user_id)
+        if response is not None:
+            self.hits += 1
+        return response
+
+    def get_stats(self) -> dict:
+        """Get pre-warm counters; hits are counted by the process that claimed the result"""
+        return {
+            "enabled": self.enabled,
+            "started": self.started,
+            "hits": self.hits,
+            "failed": self.failed,
+            "wasted": self.wasted,
+            "hit_rate": self.hits / self.started if self.started else 0.0,
+        }
@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+RESPONSE_STORE_MAX_SIZE = int(os.getenv("RESPONSE_STORE_MAX_SIZE", "10000"))
+RESPONSE_TTL = float(os.getenv("RESPONSE_TTL", "3600"))
+RESPONSE_FETCHED_TTL = float(os.getenv("RESPONSE_FETCHED_TTL", "60"))
+
+# Coalesced entries only point at the response of an identical message
+FINISHED_STATUSES = ("completed", "error", "coalesced")
+
+
+def _entry_size(message_id: str, entry: dict) -> int:
+    """Approximate bytes held by one entry"""
+    return (
+        sys.getsizeof(message_id)
+        + sys.getsizeof(entry)
+        + sum(sys.getsizeof(value) for value in entry.values())
+    )
+
+
+class ResponseStore:
+    """Bounded message_id -> response map that evicts finished entries"""
+
+    def __init__(
+        self,
+        max_size: int = RESPONSE_STORE_MAX_SIZE,
+        ttl: float = RESPONSE_TTL,
+        fetched_ttl: float = RESPONSE_FETCHED_TTL,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.fetched_ttl = fetched_ttl
+        self._entries: Dict[str, dict] = {}
+        # Finished entries in expiry order; each deadline uses a fixed TTL
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._fetched: "OrderedDict[str, float]" = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+
+    def __setitem__(self, message_id: str, entry: dict) -> None:
+        self._discard(message_id)
+        self._entries[message_id] = entry
+        self._bytes += _entry_size(message_id, entry)
+        if entry.get("status") in FINISHED_STATUSES:
+            self._finished[message_id] = time.monotonic() + self.ttl
+        self.evict()
+
+    def __getitem__(self, message_id: str) -> dict:
+        return self._entries[message_id]
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, message_id: str, default: Any = None) -> Optional[dict]:
+        return self._entries.get(message_id, default)
+
+    def mark_fetched(self, message_id: str) -> None:
+        """Shorten a finished entry's retention now that a client has it"""
+        if message_id in self._finished:
+            del self._finished[message_id]
+            self._fetched[message_id] = time.monotonic() + self.fetched_ttl
+
+    def evict(self) -> int:
+        """Drop expired finished entries, then the oldest ones past max_size"""
+        # Processing entries are never evicted; their clients are still waiting
+        now = time.monotonic()
+        evicted = 0
+        for deadlines in (self._fetched, self._finished):
+            while deadlines and next(iter(deadlines.values())) <= now:
+                self._discard(next(iter(deadlines)))
+                evicted += 1
+
+        while len(self._entries) > self.max_size and (self._fetched or self._finished):
+            deadlines = self._fetched or self._finished
+            self._discard(next(iter(deadlines)))
+            evicted += 1
+
+        self.evictions += evicted
+        return evicted
+
+    def _discard(self, message_id: str) -> None:
+        entry = self._entries.pop(message_id, None)
+        if entry is not None:
+            self._bytes -= _entry_size(message_id, entry)
+        self._finished.pop(message_id, None)
+        self._fetched.pop(message_id, None)
+
+    def get_stats(self) -> dict:
+        """Get entry counts and approximate memory held by the store"""
+        self.evict()
+        finished = len(self._finished) + len(self._fetched)
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "processing": len(self._entries) - finished,
+            "finished": len(self._finished),
+            "fetched": len(self._fetched),
+            "evictions": self.evictions,
+            "approx_bytes": self._bytes,
+        }
@@ -0,0 +1,761 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+from .cache import TTLCache
+from .history import MAX_CONVERSATION_HISTORY, ConversationHistory
+from .lanes import CHAT, LANES
+from .models import Message, User, UserMemory
+from .response_store import RESPONSE_FETCHED_TTL, RESPONSE_STORE_MAX_SIZE, RESPONSE_TTL, ResponseStore
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "memory")
+REDIS_URL = os.getenv(
+    "REDIS_URL",
+    f"redis://{os.getenv('REDIS_HOST', 'localhost')}:{os.getenv('REDIS_PORT', '6379')}/0",
+)
+# Pending stream entries idle this long belong to a dead worker and are reclaimed
+REDIS_CLAIM_IDLE_MS = int(os.getenv("REDIS_CLAIM_IDLE_MS", "300000"))
+# Seconds a waiting turn sleeps between checks when no turn-finished notice arrives
+USER_TURN_RECHECK = 5
+
+
+def _conversation_turn(message: str, message_type: str) -> dict:
+    return {
+        "message": message,
+        "type": message_type,
+        "timestamp": datetime.now().isoformat(),
+    }
+
+
+class Storage(ABC):
+    """Users, memories, the message queue and responses, shared by the API and workers"""
+
+    @abstractmethod
+    async def get_user(self, user_id: str) -> Optional[User]:
+        ...
+
+    @abstractmethod
+    async def save_user(self, user: User) -> bool:
+        ...
+
+    @abstractmethod
+    async def get_user_memory(self, user_id: str) -> UserMemory:
+        ...
+
+    @abstractmethod
+    async def get_conversations(self, user_id: str) -> list:
+        ...
+
+    @abstractmethod
+    async def get_turn_count(self, user_id: str) -> int:
+        """Get how many turns were ever stored; it changes whenever the history does"""
+
+    @abstractmethod
+    async def get_conversation_page(
+        self, user_id: str, since: int, limit: Optional[int] = None
+    ) -> Tuple[List[dict], int, int]:
+        """Get up to limit turns from absolute index since
+
+        Returns (turns, start, turn_count) where start is the index of the
+        first turn returned, later than since if older turns were trimmed.
+        """
+
+    @abstractmethod
+    async def add_conversations(self, user_id: str, turns: List[Tuple[str, str]]) -> bool:
+        """Append (message, message_type) turns, keeping the last 50"""
+
+    @abstractmethod
+    async def save_summary(self, user_id: str, summary: str, summary_through: int) -> None:
+        """Store the rolling summary of a user's turns up to summary_through"""
+
+    @abstractmethod
+    async def enqueue(self, message: Message) -> None:
+        ...
+
+    @abstractmethod
+    async def dequeue(self, lane_order: Callable[[], Sequence[str]] = lambda: LANES) -> Message:
+        """Wait for the next queued message from the first non-empty lane in lane_order()
+
+        lane_order is called again each time the worker wakes, so lanes left
+        out because they were at capacity are picked up once they have room
+        """
+
+    @abstractmethod
+    async def ack(self, message: Message) -> None:
+        """Mark a dequeued message as fully processed"""
+
+    @abstractmethod
+    async def lane_depths(self) -> Dict[str, int]:
+        """Get the number of messages waiting in each lane"""
+
+    async def queue_depth(self) -> int:
+        return sum((await self.lane_depths()).values())
+
+    @abstractmethod
+    def user_turn(self, message: Message):
+        """Async context manager that runs a user's messages in each lane in order across processes"""
+
+    @abstractmethod
+    async def set_response(self, message_id: str, response_data: dict) -> None:
+        ...
+
+    @abstractmethod
+    async def get_response(self, message_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def mark_response_fetched(self, message_id: str) -> None:
+        """Shorten a finished response's retention now that a client has it"""
+
+    @abstractmethod
+    async def publish_event(self, message_id: str, event: dict) -> None:
+        """Publish a streaming event; a "done" event ends the message's stream"""
+
+    @abstractmethod
+    def subscribe_events(self, message_id: str) -> AsyncIterator[dict]:
+        """Yield a message's events from the start until its "done" event"""
+
+    @abstractmethod
+    async def get_response_stats(self) -> dict:
+        ...
+
+    @abstractmethod
+    async def claim_message_key(self, key: str, message_id: str, ttl: float, replace: bool = False) -> Optional[str]:
+        """Map a dedup key to message_id for ttl seconds
+
+        Returns the message_id already holding the key instead, unless replace is set
+        """
+
+    @abstractmethod
+    async def get_message_key(self, key: str) -> Optional[str]:
+        """Get the message_id holding a dedup key, without claiming it"""
+
+    @abstractmethod
+    async def track_in_flight(self, user_id: str, delta: int) -> None:
+        """Adjust queued-or-running counts; finishing (-1) also counts a completion"""
+
+    @abstractmethod
+    async def get_in_flight(self, user_id: str) -> Tuple[int, int]:
+        """Get (total, per-user) queued-or-running message counts"""
+
+    @abstractmethod
+    async def get_completed_total(self) -> int:
+        ...
+
+    @abstractmethod
+    async def save_prewarm(self, user_id: str, response: str, ttl: float) -> None:
+        """Store a speculative research response for the user's first message"""
+
+    @abstractmethod
+    async def take_prewarm(self, user_id: str) -> Optional[str]:
+        """Remove and return the user's speculative research response, if any"""
+
+    @abstractmethod
+    async def get_game_state(self, user_id: str) -> Tuple[Optional[dict], int]:
+        """Get the user's game state and its version (0 when there is none)"""
+
+    @abstractmethod
+    async def save_game_state(
+        self, user_id: str, state: dict, expected_version: Optional[int] = None, bridged: Optional[bool] = None
+    ) -> Optional[int]:
+        """Store game state, returning the new version
+
+        Returns None instead if expected_version is given and no longer current.
+        bridged marks a game a bridge drives by embedding its state in each
+        message; None keeps the current mark.
+        """
+
+    @abstractmethod
+    async def is_bridged_game(self, user_id: str) -> bool:
+        """Whether the user's game was last saved from a bridge's embedded state"""
+
+    @abstractmethod
+    async def delete_game_state(self, user_id: str) -> bool:
+        """Remove the user's game state, returning whether there was one"""
+
+    async def close(self) -> None:
+        pass
+
+
+class MemoryStorage(Storage):
+    """Process-local storage; nothing survives a restart"""
+
+    def __init__(self):
+        self.users: Dict[str, User] = {}
+        self.histories: Dict[str, ConversationHistory] = {}
+        # user_id -> (summary, summary_through)
+        self.summaries: Dict[str, Tuple[str, int]] = {}
+        self.message_lanes: Dict[str, deque] = {lane: deque() for lane in LANES}
+        self._queue_changed = asyncio.Condition()
+        self.responses = ResponseStore()
+        # Streaming events for in-flight messages, replayed to late subscribers
+        self.message_events: Dict[str, List[dict]] = {}
+        self.event_subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self.in_flight: Dict[str, int] = {}
+        self.in_flight_total = 0
+        self.completed_total = 0
+        # user_id -> (response, expires_at)
+        self.prewarms: Dict[str, Tuple[str, float]] = {}
+        # Dedup key -> message_id of the message that claimed it
+        self.message_keys = TTLCache(max_size=RESPONSE_STORE_MAX_SIZE)
+        # user_id -> (game state, version)
+        self.games: Dict[str, Tuple[dict, int]] = {}
+        self.bridged_games: set = set()
+
+    async def get_user(self, user_id: str) -> Optional[User]:
+        return self.users.get(user_id)
+
+    async def save_user(self, user: User) -> bool:
+        self.users[user.connection_id] = user
+        return True
+
+    async def get_user_memory(self, user_id: str) -> UserMemory:
+        history = self.histories.get(user_id)
+        summary, summary_through = self.summaries.get(user_id, ("", 0))
+        return UserMemory(
+            user_id=user_id,
+            conversation_history=history.to_list() if history else [],
+            summary=summary,
+            summary_through=summary_through,
+            turn_count=history.turn_count if history else 0,
+        )
+
+    async def get_conversations(self, user_id: str) -> list:
+        history = self.histories.get(user_id)
+        return history.to_list() if history else []
+
+    async def get_turn_count(self, user_id: str) -> int:
+        history = self.histories.get(user_id)
+        return history.turn_count if history else 0
+
+    async def get_conversation_page(
+        self, user_id: str, since: int, limit: Optional[int] = None
+    ) -> Tuple[List[dict], int, int]:
+        history = self.histories.get(user_id)
+        if history is None:
+            return [], 0, 0
+        turns, start = history.page(since, limit)
+        return turns, start, history.turn_count
+
+    async def add_conversations(self, user_id: str, turns: List[Tuple[str, str]]) -> bool:
+        history = self.histories.get(user_id)
+        if history is None:
+            history = self.histories[user_id] = ConversationHistory()
+        # The ring buffer keeps only the last 50 turns without copying
+        for message, message_type in turns:
+            history.append(message, message_type)
+        return True
+
+    async def save_summary(self, user_id: str, summary: str, summary_through: int) -> None:
+        self.summaries[user_id] = (summary, summary_through)
+
+    async def enqueue(self, message: Message) -> None:
+        async with self._queue_changed:
+            self.message_lanes[message.lane].append(message)
+            self._queue_changed.notify_all()
+
+    async def dequeue(self, lane_order: Callable[[], Sequence[str]] = lambda: LANES) -> Message:
+        async with self._queue_changed:
+            while True:
+                for lane in lane_order():
+                    if self.message_lanes[lane]:
+                        return self.message_lanes[lane].popleft()
+                # Sleeps until enqueue puts something on a queue
+                await self._queue_changed.wait()
+
+    async def ack(self, message: Message) -> None:
+        pass
+
+    async def lane_depths(self) -> Dict[str, int]:
+        return {lane: len(messages) for lane, messages in self.message_lanes.items()}
+
+    @asynccontextmanager
+    async def user_turn(self, message: Message):
+        # The processor already serialises a user's messages in each lane
+        # within a process
+        yield
+
+    async def set_response(self, message_id: str, response_data: dict) -> None:
+        self.responses[message_id] = response_data
+
+    async def get_response(self, message_id: str) -> Optional[dict]:
+        return self.responses.get(message_id)
+
+    async def mark_response_fetched(self, message_id: str) -> None:
+        self.responses.mark_fetched(message_id)
+
+    async def publish_event(self, message_id: str, event: dict) -> None:
+        self.message_events.setdefault(message_id, []).append(event)
+        for queue in self.event_subscribers.get(message_id, []):
+            queue.put_nowait(event)
+        if event["type"] == "done":
+            self.message_events.pop(message_id, None)
+
+    async def subscribe_events(self, message_id: str) -> AsyncIterator[dict]:
+        queue: asyncio.Queue = asyncio.Queue()
+        for event in self.message_events.get(message_id, []):
+            queue.put_nowait(event)
+        subscribers = self.event_subscribers.setdefault(message_id, [])
+        subscribers.append(queue)
+        try:
+            while True:
+                event = await queue.get()
+                yield event
+                if event["type"] == "done":
+                    return
+        finally:
+            subscribers.remove(queue)
+            if not subscribers:
+                del self.event_subscribers[message_id]
+
+    async def get_response_stats(self) -> dict:
+        return self.responses.get_stats()
+
+    async def claim_message_key(self, key: str, message_id: str, ttl: float, replace: bool = False) -> Optional[str]:
+        existing = None if replace else self.message_keys.get(key)
+        if existing is None:
+            self.message_keys.set(key, message_id, ttl)
+        return existing
+
+    async def get_message_key(self, key: str) -> Optional[str]:
+        return self.message_keys.get(key)
+
+    async def track_in_flight(self, user_id: str, delta: int) -> None:
+        count = self.in_flight.get(user_id, 0) + delta
+        if count > 0:
+            self.in_flight[user_id] = count
+        else:
+            self.in_flight.pop(user_id, None)
+        self.in_flight_total += delta
+        if delta < 0:
+            self.completed_total -= delta
+
+    async def get_in_flight(self, user_id: str) -> Tuple[int, int]:
+        return self.in_flight_total, self.in_flight.get(user_id, 0)
+
+    async def get_completed_total(self) -> int:
+        return self.completed_total
+
+    async def save_prewarm(self, user_id: str, response: str, ttl: float) -> None:
+        self.prewarms[user_id] = (response, time.monotonic() + ttl)
+
+    async def take_prewarm(self, user_id: str) -> Optional[str]:
+        response, expires_at = self.prewarms.pop(user_id, (None, 0.0))
+        return response if expires_at > time.monotonic() else None
+
+    async def get_game_state(self, user_id: str) -> Tuple[Optional[dict], int]:
+        return self.games.get(user_id, (None, 0))
+
+    async def delete_game_state(self, user_id: str) -> bool:
+        self.bridged_games.discard(user_id)
+        return self.games.pop(user_id, None) is not None
+
+    async def save_game_state(
+        self, user_id: str, state: dict, expected_version: Optional[int] = None, bridged: Optional[bool] = None
+    ) -> Optional[int]:
+        _, version = self.games.get(user_id, (None, 0))
+        if expected_version is not None and expected_version != version:
+            return None
+        self.games[user_id] = (state, version + 1)
+        if bridged:
+            self.bridged_games.add(user_id)
+        elif bridged is not None:
+            self.bridged_games.discard(user_id)
+        return version + 1
+
+    async def is_bridged_game(self, user_id: str) -> bool:
+        return user_id in self.bridged_games
+
+
+class RedisStorage(Storage):
+    """Redis storage; each lane is a stream read through a consumer group"""
+
+    STREAM = "poke:messages"
+    GROUP = "poke-workers"
+
+    def __init__(self, client=None, url: str = REDIS_URL, consumer: Optional[str] = None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url, decode_responses=True)
+        self.redis = client
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self._group_ready = False
+        # message_id -> (lane, stream entry id), needed to XACK after processing
+        self._entry_ids: Dict[str, Tuple[str, str]] = {}
+        # Stream entries read or reclaimed but not yet handed to a worker
+        self._buffered: Dict[str, deque] = {lane: deque() for lane in LANES}
+        self._stream_lanes = {self._stream(lane): lane for lane in LANES}
+        # Monotonic time of the next XAUTOCLAIM sweep; the first dequeue sweeps at once
+        self._next_claim = 0.0
+
+    @classmethod
+    def _stream(cls, lane: str) -> str:
+        # Chat keeps the original stream name so messages queued before
+        # lanes existed are still processed
+        return cls.STREAM if lane == CHAT else f"{cls.STREAM}:{lane}"
+
+    @staticmethod
+    def _user_key(user_id: str) -> str:
+        return f"poke:user:{user_id}"
+
+    @staticmethod
+    def _conversations_key(user_id: str) -> str:
+        return f"poke:conversations:{user_id}"
+
+    @staticmethod
+    def _memory_key(user_id: str) -> str:
+        return f"poke:memory:{user_id}"
+
+    @staticmethod
+    def _response_key(message_id: str) -> str:
+        return f"poke:response:{message_id}"
+
+    @staticmethod
+    def _events_key(message_id: str) -> str:
+        return f"poke:events:{message_id}"
+
+    async def get_user(self, user_id: str) -> Optional[User]:
+        data = await self.redis.get(self._user_key(user_id))
+        return User.model_validate_json(data) if data else None
+
+    async def save_user(self, user: User) -> bool:
+        await self.redis.set(self._user_key(user.connection_id), user.model_dump_json())
+        return True
+
+    async def get_user_memory(self, user_id: str) -> UserMemory:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.lrange(self._conversations_key(user_id), 0, -1)
+            pipe.hgetall(self._memory_key(user_id))
+            entries, fields = await pipe.execute()
+        return UserMemory(
+            user_id=user_id,
+            conversation_history=[json.loads(entry) for entry in entries],
+            summary=fields.get("summary", ""),
+            summary_through=int(fields.get("summary_through", 0)),
+            turn_count=max(int(fields.get("turn_count", 0)), len(entries)),
+        )
+
+    async def get_conversations(self, user_id: str) -> list:
+        entries = await self.redis.lrange(self._conversations_key(user_id), 0, -1)
+        return [json.loads(entry) for entry in entries]
+
+    async def get_turn_count(self, user_id: str) -> int:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hget(self._memory_key(user_id), "turn_count")
+            pipe.llen(self._conversations_key(user_id))
+            count, length = await pipe.execute()
+        # Histories stored before turns were counted have no turn_count
+        return max(int(count or 0), length)
+
+    async def get_conversation_page(
+        self, user_id: str, since: int, limit: Optional[int] = None
+    ) -> Tuple[List[dict], int, int]:
+        # Read the count and the list atomically so indexes line up; the list
+        # is capped at 50 entries, so it's sliced here rather than in Redis
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hget(self._memory_key(user_id), "turn_count")
+            pipe.lrange(self._conversations_key(user_id), 0, -1)
+            count, entries = await pipe.execute()
+        turn_count = max(int(count or 0), len(entries))
+        first = turn_count - len(entries)
+        start = min(max(since, first), turn_count)
+        stop = turn_count if limit is None else min(turn_count, start + limit)
+        return [json.loads(entry) for entry in entries[start - first:stop - first]], start, turn_count
+
+    async def add_conversations(self, user_id: str, turns: List[Tuple[str, str]]) -> bool:
+        key = self._conversations_key(user_id)
+        # One round trip for the append, the trim and the count, applied
+        # atomically so readers never see the list and count out of step
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *[json.dumps(_conversation_turn(message, message_type)) for message, message_type in turns])
+            pipe.ltrim(key, -MAX_CONVERSATION_HISTORY, -1)
+            pipe.hincrby(self._memory_key(user_id), "turn_count", len(turns))
+            await pipe.execute()
+        return True
+
+    async def save_summary(self, user_id: str, summary: str, summary_through: int) -> None:
+        await self.redis.hset(
+            self._memory_key(user_id),
+            mapping={"summary": summary, "summary_through": summary_through},
+        )
+
+    async def _ensure_group(self) -> None:
+        if self._group_ready:
+            return
+        for lane in LANES:
+            try:
+                await self.redis.xgroup_create(self._stream(lane), self.GROUP, id="0", mkstream=True)
+            except Exception as e:
+                # BUSYGROUP means another process created it first
+                if "BUSYGROUP" not in str(e):
+                    raise
+        self._group_ready = True
+
+    async def enqueue(self, message: Message) -> None:
+        # Per-user sequence numbers let user_turn keep order across processes
+        message.sequence = await self.redis.incr(self._user_lane_key("seq", message))
+        entry_id = await self.redis.xadd(self._stream(message.lane), {"data": message.model_dump_json()})
+        # Only once the entry exists, so a crash in between can't leave a
+        # pending turn that nothing will ever run
+        await self.redis.zadd(self._user_lane_key("pending", message), {entry_id: message.sequence})
+
+    @staticmethod
+    def _user_lane_key(kind: str, message: Message) -> str:
+        # Order is kept per lane, so research can't hold up the same user's chat
+        key = f"poke:{kind}:user:{message.user_id}"
+        return key if message.lane == CHAT else f"{key}:{message.lane}"
+
+    async def _reclaim(self) -> None:
+        """Pick up work a crashed or restarted worker left unacknowledged"""
+        in_progress = set(self._entry_ids.values())
+        for lane in LANES:
+            _, claimed, *_ = await self.redis.xautoclaim(
+                self._stream(lane), self.GROUP, self.consumer, REDIS_CLAIM_IDLE_MS, start_id="0-0"
+            )
+            claimed = [entry for entry in claimed if (lane, entry[0]) not in in_progress]
+            if claimed:
+                logger.info(f"Reclaimed {len(claimed)} unacknowledged {lane} messages")
+                self._buffered[lane].extend(claimed)
+        # On a timer rather than when the streams go quiet, so a dead worker's
+        # messages are picked up under steady load too
+        self._next_claim = time.monotonic() + REDIS_CLAIM_IDLE_MS / 2000
+
+    async def dequeue(self, lane_order: Callable[[], Sequence[str]] = lambda: LANES) -> Message:
+        await self._ensure_group()
+
+        while True:
+            if time.monotonic() >= self._next_claim:
+                await self._reclaim()
+
+            lanes = lane_order()
+            ready = any(self._buffered[lane] for lane in lanes)
+            # Always look for newer work in higher lanes, but only block when
+            # nothing is buffered locally
+            response = await self.redis.xreadgroup(
+                self.GROUP,
+                self.consumer,
+                {self._stream(lane): ">" for lane in lanes},
+                count=1,
+                # Wake in time for the next sweep
+                block=None if ready else max(1, min(5000, int((self._next_claim - time.monotonic()) * 1000))),
+            )
+            for stream, entries in response or []:
+                self._buffered[self._stream_lanes[stream]].extend(entries)
+
+            for lane in lanes:
+                if self._buffered[lane]:
+                    entry_id, fields = self._buffered[lane].popleft()
+                    message = Message.model_validate_json(fields["data"])
+                    self._entry_ids[message.message_id] = (lane, entry_id)
+                    return message
+
+    async def ack(self, message: Message) -> None:
+        lane, entry_id = self._entry_ids.pop(message.message_id, (None, None))
+        if entry_id:
+            stream = self._stream(lane)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xack(stream, self.GROUP, entry_id)
+                pipe.xdel(stream, entry_id)
+                await pipe.execute()
+
+    async def lane_depths(self) -> Dict[str, int]:
+        await self._ensure_group()
+        # Acknowledged entries are deleted, so each stream holds undelivered
+        # messages plus the pending ones workers are still processing
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for lane in LANES:
+                pipe.xlen(self._stream(lane))
+                pipe.xpending(self._stream(lane), self.GROUP)
+            results = await pipe.execute()
+        return {
+            lane: length - pending["pending"]
+            for lane, length, pending in zip(LANES, results[::2], results[1::2])
+        }
+
+    async def _earlier_pending(self, message: Message) -> Optional[str]:
+        """The stream entry of the user's oldest message queued before this one, if any"""
+        key = self._user_lane_key("pending", message)
+        while True:
+            earlier = await self.redis.zrangebyscore(key, "-inf", f"({message.sequence}", start=0, num=1)
+            if not earlier:
+                return None
+            if await self.redis.xrange(self._stream(message.lane), earlier[0], earlier[0]):
+                return earlier[0]
+            # Acknowledged, or deleted without running; either way nothing
+            # will finish it, so it is a gap rather than a turn to wait for
+            await self.redis.zrem(key, earlier[0])
+
+    @asynccontextmanager
+    async def user_turn(self, message: Message):
+        _, entry_id = self._entry_ids.get(message.message_id, (None, None))
+        channel = self._user_lane_key("turns", message)
+        # Wait for the user's earlier messages, wherever they are running.
+        # One that was reclaimed from a dead worker is still waited for, so
+        # order holds; its new worker runs it once the claim window passes
+        if await self._earlier_pending(message):
+            pubsub = self.redis.pubsub()
+            try:
+                # Subscribed before re-checking, so a turn finishing in between isn't missed
+                await pubsub.subscribe(channel)
+                while await self._earlier_pending(message):
+                    # The timeout only re-checks for predecessors deleted without a notice
+                    await pubsub.get_message(ignore_subscribe_messages=True, timeout=USER_TURN_RECHECK)
+            finally:
+                await pubsub.aclose()
+        try:
+            yield
+        except asyncio.CancelledError:
+            # Left pending for reclaim, so the user's later messages keep waiting for it
+            raise
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if entry_id:
+                pipe.zrem(self._user_lane_key("pending", message), entry_id)
+            pipe.publish(channel, message.sequence)
+            await pipe.execute()
+
+    async def set_response(self, message_id: str, response_data: dict) -> None:
+        await self.redis.set(self._response_key(message_id), json.dumps(response_data), ex=int(RESPONSE_TTL))
+
+    async def get_response(self, message_id: str) -> Optional[dict]:
+        data = await self.redis.get(self._response_key(message_id))
+        return json.loads(data) if data else None
+
+    async def mark_response_fetched(self, message_id: str) -> None:
+        await self.redis.expire(self._response_key(message_id), int(RESPONSE_FETCHED_TTL))
+
+    async def publish_event(self, message_id: str, event: dict) -> None:
+        key = self._events_key(message_id)
+        # The per-message stream doubles as the replay log for late subscribers
+        ttl = RESPONSE_FETCHED_TTL if event["type"] == "done" else RESPONSE_TTL
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"data": json.dumps(event)})
+            pipe.expire(key, int(ttl))
+            await pipe.execute()
+
+    async def subscribe_events(self, message_id: str) -> AsyncIterator[dict]:
+        key = self._events_key(message_id)
+        last_id = "0-0"
+        while True:
+            response = await self.redis.xread({key: last_id}, block=5000)
+            for _, entries in response or []:
+                for entry_id, fields in entries:
+                    last_id = entry_id
+                    event = json.loads(fields["data"])
+                    yield event
+                    if event["type"] == "done":
+                        return
+            if not response and not await self.redis.exists(self._response_key(message_id)):
+                # The response expired without a done event ever arriving
+                return
+
+    async def get_response_stats(self) -> dict:
+        # Redis expires responses itself, so only the retention policy is known here
+        return {"ttl": RESPONSE_TTL, "fetched_ttl": RESPONSE_FETCHED_TTL}
+
+    async def claim_message_key(self, key: str, message_id: str, ttl: float, replace: bool = False) -> Optional[str]:
+        key = f"poke:message_key:{key}"
+        # SET NX, so of two identical requests racing only one claims the key
+        if await self.redis.set(key, message_id, ex=max(1, int(ttl)), nx=not replace):
+            return None
+        return await self.redis.get(key)
+
+    async def get_message_key(self, key: str) -> Optional[str]:
+        return await self.redis.get(f"poke:message_key:{key}")
+
+    async def track_in_flight(self, user_id: str, delta: int) -> None:
+        from redis.exceptions import WatchError
+
+        key = "poke:in_flight:users"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.incrby("poke:in_flight:total", delta)
+            pipe.hincrby(key, user_id, delta)
+            if delta < 0:
+                pipe.incrby("poke:completed:total", -delta)
+            _, count, *_ = await pipe.execute()
+        if count > 0:
+            return
+        # Drop idle users so the hash doesn't keep a field for everyone who
+        # ever sent a message; WATCH, so a message queued meanwhile survives
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(key)
+            if int(await pipe.hget(key, user_id) or 0) > 0:
+                return
+            pipe.multi()
+            pipe.hdel(key, user_id)
+            try:
+                await pipe.execute()
+            except WatchError:
+                pass
+
+    async def get_in_flight(self, user_id: str) -> Tuple[int, int]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get("poke:in_flight:total")
+            pipe.hget("poke:in_flight:users", user_id)
+            total, user = await pipe.execute()
+        return int(total or 0), int(user or 0)
+
+    async def get_completed_total(self) -> int:
+        return int(await self.redis.get("poke:completed:total") or 0)
+
+    async def save_prewarm(self, user_id: str, response: str, ttl: float) -> None:
+        await self.redis.set(f"poke:prewarm:{user_id}", response, ex=int(ttl))
+
+    async def take_prewarm(self, user_id: str) -> Optional[str]:
+        # GETDEL, so only one worker can claim it
+        return await self.redis.getdel(f"poke:prewarm:{user_id}")
+
+    async def get_game_state(self, user_id: str) -> Tuple[Optional[dict], int]:
+        fields = await self.redis.hgetall(f"poke:game:{user_id}")
+        if not fields:
+            return None, 0
+        return json.loads(fields["state"]), int(fields["version"])
+
+    async def delete_game_state(self, user_id: str) -> bool:
+        return bool(await self.redis.delete(f"poke:game:{user_id}"))
+
+    async def save_game_state(
+        self, user_id: str, state: dict, expected_version: Optional[int] = None, bridged: Optional[bool] = None
+    ) -> Optional[int]:
+        from redis.exceptions import WatchError
+
+        key = f"poke:game:{user_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            # WATCH, so a concurrent save between the check and the write aborts this one
+            await pipe.watch(key)
+            version = int(await pipe.hget(key, "version") or 0)
+            if expected_version is not None and expected_version != version:
+                return None
+            pipe.multi()
+            fields = {"state": json.dumps(state), "version": version + 1}
+            if bridged is not None:
+                fields["bridged"] = int(bridged)
+            pipe.hset(key, mapping=fields)
+            try:
+                await pipe.execute()
+            except WatchError:
+                return None
+        return version + 1
+
+    async def is_bridged_game(self, user_id: str) -> bool:
+        return await self.redis.hget(f"poke:game:{user_id}", "bridged") == "1"
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+
+def create_storage() -> Storage:
+    """Create the storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "redis":
+        logger.info(f"Using Redis storage at {REDIS_URL}")
+        return RedisStorage()
+    return MemoryStorage()
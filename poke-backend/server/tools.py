@@ -1,6 +1,69 @@
+import asyncio
+import functools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from .cache import TTLCache
+from .cassette import cassette
 from .constants import composio
+from .metrics import TOOL_CALL, TOOL_SCHEMA_FETCH
 from composio import Composio
 
+GOOGLE_TOOLS = [
+    "GMAIL_SEARCH_PEOPLE",
+    "GMAIL_GET_PROFILE",
+    "GMAIL_SEND_EMAIL",
+    "GMAIL_GET_EMAIL_THREAD",
+    "GMAIL_CREATE_EMAIL_DRAFT",
+    "COMPOSIO_SEARCH_SEARCH",
+    "COMPOSIO_SEARCH_EXA_SIMILARLINK",
+    "COMPOSIO_SEARCH_EXA_ANSWER",
+]
+
+# Tools without side effects whose results can be reused, with their TTLs
+# in seconds. Anything else, e.g. GMAIL_SEND_EMAIL, always runs
+TOOL_RESULT_TTL = float(os.getenv("TOOL_RESULT_CACHE_TTL", "900"))
+CACHEABLE_TOOLS: Dict[str, float] = {
+    "GMAIL_SEARCH_PEOPLE": TOOL_RESULT_TTL,
+    "GMAIL_GET_PROFILE": max(TOOL_RESULT_TTL, 3600),
+    "GMAIL_GET_EMAIL_THREAD": TOOL_RESULT_TTL,
+    "COMPOSIO_SEARCH_SEARCH": TOOL_RESULT_TTL,
+    "COMPOSIO_SEARCH_EXA_SIMILARLINK": TOOL_RESULT_TTL,
+    "COMPOSIO_SEARCH_EXA_ANSWER": TOOL_RESULT_TTL,
+}
+
+# Parallel tool calls allowed per agent turn, and how long one may take
+TOOL_CONCURRENCY = int(os.getenv("TOOL_CONCURRENCY", "4"))
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "30"))
+# A timed-out call keeps running in its thread, so side-effecting tools are
+# never timed out; the model might otherwise send the same email twice
+UNTIMED_TOOLS = {"GMAIL_SEND_EMAIL", "GMAIL_CREATE_EMAIL_DRAFT"}
+
+# Composio's SDK is synchronous, so tool calls get their own thread pool
+tool_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TOOL_THREADS", "32")), thread_name_prefix="poke-tool"
+)
+# Shared by the tool calls of the current agent turn, see tool_turn()
+_turn_slots: ContextVar[Optional[asyncio.Semaphore]] = ContextVar("tool_turn_slots", default=None)
+
+# Tool schemas keyed by (user_id, tool names); they rarely change upstream
+tool_schema_cache = TTLCache(
+    max_size=int(os.getenv("TOOL_SCHEMA_CACHE_SIZE", "1000")),
+    ttl=float(os.getenv("TOOL_SCHEMA_CACHE_TTL", "3600")),
+)
+# Read-only tool results keyed by (user_id, tool name, normalized arguments)
+tool_result_cache = TTLCache(
+    max_size=int(os.getenv("TOOL_RESULT_CACHE_SIZE", "10000")),
+    ttl=TOOL_RESULT_TTL,
+)
+# tool name -> {"calls": n, "timeouts": n, "hits": n, "misses": n}
+tool_stats: Dict[str, Dict[str, int]] = {}
+
 def get_stripe_tools(composio_client: Composio, user_id: str):
     return composio_client.tools.get(user_id,
         toolkits=[
@@ -9,6 +72,120 @@ def get_stripe_tools(composio_client: Composio, user_id: str):
     )
     
 def get_google_tools(composio_client: Composio, user_id: str):
-    return composio_client.tools.get(user_id, tools=["GMAIL_SEARCH_PEOPLE", "GMAIL_GET_PROFILE", "GMAIL_SEND_EMAIL", "GMAIL_GET_EMAIL_THREAD"
-            "GMAIL_CREATE_EMAIL_DRAFT", "COMPOSIO_SEARCH_SEARCH", "COMPOSIO_SEARCH_EXA_SIMILARLINK", "COMPOSIO_SEARCH_EXA_ANSWER"])
+    return composio_client.tools.get(user_id, tools=GOOGLE_TOOLS)
+
+async def get_cached_google_tools(composio_client: Composio, user_id: str):
+    """Get Gmail and search tools, fetching schemas off the event loop on a cache miss"""
+    async def load():
+        if cassette and cassette.mode == "replay":
+            tools = cassette.tools(user_id)
+        else:
+            with TOOL_SCHEMA_FETCH.time():
+                tools = await asyncio.to_thread(get_google_tools, composio_client, user_id)
+            if cassette:
+                cassette.record_schemas(user_id, tools)
+        for tool in tools:
+            tool.coroutine = _async_tool_call(tool.name, tool.func, user_id)
+        return tools
+
+    return await tool_schema_cache.get_or_load((user_id, tuple(GOOGLE_TOOLS)), load)
+
+def _normalize_arguments(arguments: Dict[str, Any]) -> str:
+    """Canonical form of tool arguments, so equivalent calls share a cache entry"""
+    def normalize(value):
+        if isinstance(value, str):
+            return " ".join(value.split())
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items() if item is not None}
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        return value
+
+    return json.dumps(normalize(arguments), sort_keys=True, default=str)
+
+@contextmanager
+def tool_turn(concurrency: int = TOOL_CONCURRENCY):
+    """Scope an agent turn, so its parallel tool calls share one concurrency limit"""
+    token = _turn_slots.set(asyncio.Semaphore(concurrency))
+    try:
+        yield
+    finally:
+        _turn_slots.reset(token)
+
+def _failed(result: Any) -> bool:
+    """Whether a tool result is a failed Composio call"""
+    return isinstance(result, dict) and result.get("successful") is False
+
+def _async_tool_call(tool_name: str, func, user_id: str):
+    """Async tool implementation with the turn's concurrency limit, a timeout
+    and, for read-only tools, memoized results
+
+    ToolNode gathers a message's tool calls, so they run in parallel.
+    """
+    stats = tool_stats.setdefault(tool_name, {"calls": 0, "timeouts": 0, "hits": 0, "misses": 0})
+    timeout = None if tool_name in UNTIMED_TOOLS else TOOL_TIMEOUT
+
+    async def run(kwargs: dict):
+        if cassette and cassette.mode == "replay":
+            return await cassette.tool_result(user_id, tool_name, _normalize_arguments(kwargs))
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        result = await loop.run_in_executor(tool_executor, functools.partial(func, **kwargs))
+        if cassette:
+            cassette.record_tool(user_id, tool_name, _normalize_arguments(kwargs), result, time.perf_counter() - started)
+        return result
+
+    async def run_cached(kwargs: dict):
+        key = (user_id, tool_name, _normalize_arguments(kwargs))
+        hit = key in tool_result_cache
+        stats["hits" if hit else "misses"] += 1
+        result = await tool_result_cache.get_or_load(
+            key,
+            lambda: run(kwargs),
+            ttl=CACHEABLE_TOOLS[tool_name],
+            # Failed calls are retried next time rather than remembered
+            cache_if=lambda result: not _failed(result),
+        )
+        return result, hit
+
+    async def call(**kwargs):
+        stats["calls"] += 1
+        async with _turn_slots.get() or nullcontext():
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                if tool_name in CACHEABLE_TOOLS:
+                    result, hit = await asyncio.wait_for(run_cached(kwargs), timeout)
+                else:
+                    result, hit = await asyncio.wait_for(run(kwargs), timeout), False
+                if not _failed(result):
+                    outcome = "cached" if hit else "ok"
+                return result
+            except asyncio.TimeoutError:
+                stats["timeouts"] += 1
+                outcome = "timeout"
+                # Same shape as a failed Composio call, so the model can carry on
+                return {"successful": False, "data": None, "error": f"{tool_name} timed out after {timeout:g}s"}
+            finally:
+                TOOL_CALL.labels(tool_name, outcome).observe(time.perf_counter() - started)
+
+    return call
+
+def invalidate_tool_schemas(user_id: str) -> int:
+    """Drop every cached tool schema for a user, and results that depend on their Gmail account"""
+    # Search results don't depend on the connected account, so they survive reconnects
+    tool_result_cache.invalidate_where(lambda key: key[0] == user_id and key[1].startswith("GMAIL_"))
+    return tool_schema_cache.invalidate_where(lambda key: key[0] == user_id)
+
+def get_tool_result_stats() -> dict:
+    """Get tool result cache counters"""
+    return tool_result_cache.get_stats()
+
+def get_tool_stats() -> dict:
+    """Get per-tool call, timeout and cache counters"""
+    return {
+        "concurrency": TOOL_CONCURRENCY,
+        "timeout": TOOL_TIMEOUT,
+        "tools": {name: dict(counts) for name, counts in tool_stats.items()},
+    }
 
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import time
+
+# Before anything imports server.constants, which builds the API clients
+os.environ.setdefault("COMPOSIO_API_KEY", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["CASSETTE_MODE"] = "off"
+
+import httpx
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import StructuredTool
+
+from server import api
+from server.admission import AdmissionController
+from server.message_processor import MessageProcessor
+from server.storage import MemoryStorage
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that answers from a script after a delay
+
+    The sync path blocks its thread for the delay, like a real blocking HTTP
+    call would, so code that calls the model synchronously stalls the loop.
+    """
+
+    replies: list = ["ok"]
+    delay: float = 0.0
+    calls: int = 0
+    # The messages of every request, oldest first
+    requests: list = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _reply(self, messages) -> ChatResult:
+        self.requests.append(messages)
+        reply = self.replies[self.calls % len(self.replies)]
+        self.calls += 1
+        message = reply if isinstance(reply, AIMessage) else AIMessage(content=reply)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.delay)
+        return self._reply(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        return self._reply(messages)
+
+
+def lookup(query: str) -> str:
+    """Look something up"""
+    return "found"
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def storage():
+    return MemoryStorage()
+
+
+@pytest.fixture
+def tools(monkeypatch):
+    """Give every user one tool, so turns run through the agent graph"""
+    user_tools = [StructuredTool.from_function(lookup)]
+
+    async def get_tools(composio_client, user_id):
+        return user_tools
+
+    monkeypatch.setattr("server.agent.get_cached_google_tools", get_tools)
+    return user_tools
+
+
+@pytest.fixture
+def make_processor(storage, tools):
+    """Build a MessageProcessor on the fake model; workers are stopped afterwards"""
+    started = []
+
+    def make(model: FakeChatModel, num_workers: int = 2) -> MessageProcessor:
+        processor = MessageProcessor(storage, num_workers=num_workers)
+        processor.agent.model = model
+        processor.context.model = model
+        started.append(processor)
+        return processor
+
+    yield make
+    for processor in started:
+        processor.processing = False
+        for worker in processor._workers:
+            worker.cancel()
+
+
+async def wait_for_response(processor: MessageProcessor, message_id: str, timeout: float = 5.0) -> dict:
+    """Poll a message's response until it leaves "processing\""""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = await processor.get_message_response(message_id)
+        if response["status"] not in ("processing", "not_found"):
+            return response
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Message {message_id} still processing after {timeout}s")
+
+
+@pytest.fixture
+async def api_client(storage, make_processor, monkeypatch):
+    """HTTP client for the app, on the test storage and a processor whose workers aren't started"""
+    monkeypatch.setattr(api, "storage", storage)
+    monkeypatch.setattr(api, "message_processor", make_processor(FakeChatModel()))
+    monkeypatch.setattr(api, "admission", AdmissionController(storage))
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://test") as client:
+        yield client
@@ -0,0 +1,27 @@
+import pytest
+
+from server.admission import AdmissionController
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_in_flight_rejection_keeps_rate_token(storage):
+    admission = AdmissionController(storage, max_user_in_flight=1, user_rate=0.001, user_burst=1)
+    await storage.track_in_flight("u", 1)
+
+    assert await admission.check("u") is not None
+    assert admission.rejected["user_in_flight"] == 1
+
+    await storage.track_in_flight("u", -1)
+    # The rejected message didn't spend the user's only token
+    assert await admission.check("u") is None
+    assert admission.rejected["rate_limited"] == 0
+
+
+async def test_server_started_work_skips_the_rate_limit(storage):
+    admission = AdmissionController(storage, max_in_flight=1, user_rate=0.001, user_burst=1)
+    assert await admission.check("u") is None
+    assert await admission.check("u", rate_limited=False) is None
+
+    await storage.track_in_flight("v", 1)
+    assert await admission.check("u", rate_limited=False) is not None
@@ -0,0 +1,35 @@
+import os
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from server.cassette import Cassette, ReplayChatModel
+
+
+def record(path, pid, monkeypatch, user_id):
+    monkeypatch.setattr(os, "getpid", lambda: pid)
+    cassette = Cassette(str(path), "record")
+    cassette.record_message(user_id, "hi")
+    cassette.record_llm([HumanMessage(content=f"hi from {user_id}")], AIMessage(content=f"hello {user_id}"), 0.5)
+    cassette.close()
+    return cassette.path
+
+
+def test_each_process_records_its_own_file(tmp_path, monkeypatch):
+    path = tmp_path / "poke-cassette.jsonl.gz"
+    first = record(path, 101, monkeypatch, "a")
+    second = record(path, 102, monkeypatch, "b")
+
+    assert sorted(os.listdir(tmp_path)) == ["poke-cassette.101.jsonl.gz", "poke-cassette.102.jsonl.gz"]
+    assert first != second
+
+    replay = Cassette(str(path), "replay", time_scale=0)
+    assert [user_id for _, user_id, _ in replay.messages] == ["a", "b"]
+    assert replay.messages[0][0] == 0
+
+
+def test_replay_model_answers_sync_calls(tmp_path, monkeypatch):
+    path = tmp_path / "poke-cassette.jsonl"
+    record(path, 101, monkeypatch, "a")
+
+    model = ReplayChatModel(cassette=Cassette(str(path), "replay", time_scale=0))
+    assert model.invoke([HumanMessage(content="hi from a")]).content == "hello a"
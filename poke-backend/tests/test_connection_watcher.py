@@ -0,0 +1,26 @@
+import pytest
+
+from server import connection_watcher
+from server.connection_watcher import ConnectionWatcher
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_gave_up_connection_is_fetched_again(monkeypatch):
+    monkeypatch.setattr(connection_watcher, "CONNECTION_WATCH_TIMEOUT", 0.05)
+    monkeypatch.setattr(connection_watcher, "CONNECTION_POLL_MIN_INTERVAL", 0.01)
+    statuses = ["INITIATED"]
+    watcher = ConnectionWatcher(composio_client=None)
+
+    async def fetch_status(connection_id):
+        watcher.upstream_polls += 1
+        return statuses[-1]
+
+    monkeypatch.setattr(watcher, "_fetch_status", fetch_status)
+    entry = watcher.watch("c", "u", "INITIATED")
+    await entry.task
+    assert "c" not in watcher.connections
+
+    # Authorised after the watcher gave up
+    statuses.append("ACTIVE")
+    assert await watcher.get_status("c") == "ACTIVE"
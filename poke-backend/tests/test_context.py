@@ -0,0 +1,25 @@
+import pytest
+
+from conftest import FakeChatModel
+from server.context import ContextBuilder
+from server.models import UserMemory
+
+pytestmark = pytest.mark.anyio
+
+
+def memory_with_turns(n):
+    history = [{"message": f"turn {i}", "type": "user" if i % 2 == 0 else "agent"} for i in range(n)]
+    return UserMemory(user_id="u", conversation_history=history, turn_count=n)
+
+
+async def test_update_summary_folds_old_turns():
+    context = ContextBuilder(FakeChatModel(replies=["the gist"]), token_budget=10, batch_turns=2)
+    summary, summary_through = await context.update_summary(memory_with_turns(12))
+    assert summary == "the gist"
+    assert 2 <= summary_through < 12
+
+
+async def test_empty_summary_keeps_old_one():
+    context = ContextBuilder(FakeChatModel(replies=[""]), token_budget=10, batch_turns=2)
+    assert await context.update_summary(memory_with_turns(12)) is None
+    assert context.summaries == 0
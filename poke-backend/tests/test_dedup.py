@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeChatModel
+from server import api
+from server.admission import AdmissionController
+from server.models import User
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_concurrent_duplicates_run_once(make_processor, storage, monkeypatch):
+    processor = make_processor(FakeChatModel())
+    set_response = storage.set_response
+
+    async def slow_set_response(message_id, response_data):
+        # Let the other request in between each storage call
+        await asyncio.sleep(0)
+        await set_response(message_id, response_data)
+
+    monkeypatch.setattr(storage, "set_response", slow_set_response)
+    first, second = await asyncio.gather(
+        processor.queue_user_message("u", "hi", idempotency_key="k"),
+        processor.queue_user_message("u", "hi", idempotency_key="k"),
+    )
+
+    assert await storage.lane_depths() == {"chat": 1, "game": 0, "research": 0}
+    assert (await storage.get_response(second))["coalesced_into"] == first
+
+
+async def test_retry_is_not_charged_admission(api_client, storage):
+    api.admission = AdmissionController(storage, user_rate=0.001, user_burst=1)
+    await storage.save_user(User(connection_id="u"))
+    body = {"user_id": "u", "content": "hi"}
+
+    first = await api_client.post("/messages", json=body, headers={"Idempotency-Key": "k"})
+    retry = await api_client.post("/messages", json=body, headers={"Idempotency-Key": "k"})
+    other = await api_client.post("/messages", json=body)
+
+    assert first.status_code == retry.status_code == 200
+    assert (await storage.get_response(retry.json()["message_id"]))["coalesced_into"] == first.json()["message_id"]
+    # A genuinely new message still spends the user's rate allowance
+    assert other.status_code == 429
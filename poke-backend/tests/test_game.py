@@ -0,0 +1,139 @@
+import json
+
+import pytest
+
+from server.game import GamePatchError, GameStore, apply_patch, parse_reply
+from server.models import User
+
+pytestmark = pytest.mark.anyio
+
+STATE = {"player": {"hp": 10}, "location": "cave", "inventory": ["torch"]}
+
+
+def embedded(state, action="go north"):
+    return f"Current Game State: {json.dumps(state)}\n{action}"
+
+
+def test_apply_patch_leaves_original_alone():
+    patched = apply_patch(STATE, [{"op": "replace", "path": "/player/hp", "value": 7}])
+    assert patched["player"]["hp"] == 7
+    assert STATE["player"]["hp"] == 10
+
+
+@pytest.mark.parametrize("patch", [
+    {"op": "add", "path": "/gold", "value": 1},
+    [{"op": "remove", "path": "/missing"}],
+    [{"op": "replace", "path": "", "value": []}],
+])
+def test_apply_patch_rejects_invalid_patches(patch):
+    with pytest.raises(GamePatchError):
+        apply_patch(STATE, patch)
+
+
+def test_parse_reply_strips_the_patch():
+    text, patch, state = parse_reply('You light the torch.\n```json-patch\n[{"op": "add", "path": "/lit", "value": true}]\n```')
+    assert text == "You light the torch."
+    assert patch == [{"op": "add", "path": "/lit", "value": True}]
+    assert state is None
+
+
+def test_parse_reply_accepts_a_full_state():
+    text, patch, state = parse_reply('You rest.\n```json\n{"location": "camp"}\n```')
+    assert (text, patch, state) == ("You rest.", None, {"location": "camp"})
+
+
+def test_parse_reply_keeps_an_unparseable_patch_for_rejection():
+    _, patch, _ = parse_reply("Oops\n```json-patch\nnot json\n```")
+    assert patch.strip() == "not json"
+
+
+async def test_prepare_then_apply_reply(storage):
+    games = GameStore(storage)
+    await games.save("u", STATE)
+
+    prompt, action = await games.prepare("u", "go north")
+    assert "version 1" in prompt and action == "go north"
+
+    text, game = await games.apply_reply(
+        "u", 'You walk north.\n```json-patch\n[{"op": "replace", "path": "/location", "value": "forest"}]\n```'
+    )
+    assert text == "You walk north."
+    assert game["version"] == 2
+    assert await storage.get_game_state("u") == ({**STATE, "location": "forest"}, 2)
+
+
+async def test_rejected_patch_keeps_the_state(storage):
+    games = GameStore(storage)
+    await games.save("u", STATE)
+    _, game = await games.apply_reply("u", 'Hm.\n```json-patch\n[{"op": "remove", "path": "/missing"}]\n```')
+    assert game["version"] == 1 and "error" in game
+    assert await storage.get_game_state("u") == (STATE, 1)
+
+
+async def test_embedded_state_starts_a_game(storage):
+    games = GameStore(storage)
+    _, action = await games.prepare("u", embedded(STATE))
+    assert action == "go north"
+    assert await storage.get_game_state("u") == (STATE, 1)
+
+
+async def test_stale_embedded_state_is_ignored(storage):
+    games = GameStore(storage)
+    await games.save("u", STATE)
+    await games.save("u", {**STATE, "location": "forest"})
+
+    prompt, _ = await games.prepare("u", embedded(STATE), sent_version=1)
+    assert '"location":"forest"' in prompt
+    assert (await storage.get_game_state("u"))[1] == 2
+    assert games.stale_states == 1
+
+    await games.prepare("u", embedded({**STATE, "location": "lake"}), sent_version=2)
+    assert await storage.get_game_state("u") == ({**STATE, "location": "lake"}, 3)
+
+
+async def test_messages_follow_the_stored_game(make_processor, storage):
+    processor = make_processor(None)
+    await processor.games.save("u", STATE)
+
+    await processor.queue_user_message("u", "go north")
+    await processor.queue_user_message("u", "what's on my calendar?", mode="chat")
+
+    assert {lane: depth for lane, depth in (await storage.lane_depths()).items() if depth} == {"game": 1, "chat": 1}
+
+
+async def test_embedded_state_routes_a_new_user_to_game(make_processor, storage):
+    processor = make_processor(None)
+    await processor.queue_user_message("v", embedded(STATE, "I go north"))
+    message = await storage.dequeue()
+    assert message.lane == "game"
+
+    prompt, action = await processor.games.prepare("v", message.content, message.game_version)
+    assert action == "I go north" and "version 1" in prompt
+    assert await storage.get_game_state("v") == (STATE, 1)
+
+
+async def test_bridge_game_returns_to_chat_without_an_embedded_state(make_processor, storage):
+    processor = make_processor(None)
+    await processor.games.prepare("v", embedded(STATE))
+
+    await processor.queue_user_message("v", "what's on my calendar?")
+    assert (await storage.dequeue()).lane == "chat"
+
+    # A game started through the API is server-driven again
+    await processor.games.save("v", STATE)
+    await processor.queue_user_message("v", "go north")
+    assert (await storage.dequeue()).lane == "game"
+
+
+async def test_game_version_conflict_is_412(api_client, storage):
+    await storage.save_user(User(connection_id="u"))
+    assert (await api_client.put("/users/u/game", json={"state": STATE})).status_code == 200
+
+    patch = {"patch": [{"op": "replace", "path": "/location", "value": "forest"}]}
+    assert (await api_client.patch("/users/u/game", json=patch, headers={"If-Match": '"1"'})).status_code == 200
+    stale = await api_client.patch("/users/u/game", json=patch, headers={"If-Match": '"1"'})
+    assert stale.status_code == 412
+    assert (await api_client.put("/users/u/game", json={"state": STATE}, headers={"If-Match": '"1"'})).status_code == 412
+
+    assert (await api_client.delete("/users/u/game")).status_code == 200
+    assert (await api_client.get("/users/u/game")).status_code == 404
@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from server import api
+
+from conftest import FakeChatModel, wait_for_response
+
+pytestmark = pytest.mark.anyio
+
+TURN_SECONDS = 1.0
+# Far below one model call, so a single blocking call would fail the test
+HEALTH_BOUND_SECONDS = 0.2
+
+
+async def test_health_stays_fast_while_turns_run(make_processor):
+    processor = make_processor(FakeChatModel(delay=TURN_SECONDS), num_workers=4)
+    workers = asyncio.create_task(processor.start_processing())
+
+    message_ids = [await processor.queue_user_message(f"user-{n}", "hi") for n in range(4)]
+
+    latencies = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://test") as client:
+        # Give the workers time to reach the model
+        await asyncio.sleep(0.1)
+        started = time.monotonic()
+        while time.monotonic() - started < TURN_SECONDS * 0.8:
+            sent = time.perf_counter()
+            response = await client.get("/health")
+            latencies.append(time.perf_counter() - sent)
+            assert response.status_code == 200
+            await asyncio.sleep(0.05)
+        # The turns were in flight the whole time
+        assert processor.active_workers == 4
+
+    for message_id in message_ids:
+        assert (await wait_for_response(processor, message_id))["status"] == "completed"
+    assert max(latencies) < HEALTH_BOUND_SECONDS, f"/health took {max(latencies):.3f}s"
+
+    await processor.stop_processing()
+    workers.cancel()
@@ -0,0 +1,99 @@
+import fakeredis
+import pytest
+
+from server.history import MAX_CONVERSATION_HISTORY
+from server.storage import MemoryStorage, RedisStorage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(params=["memory", "redis"])
+def storage(request):
+    """Both backends, since each pages its history its own way"""
+    if request.param == "memory":
+        return MemoryStorage()
+    return RedisStorage(client=fakeredis.aioredis.FakeRedis(decode_responses=True), consumer="test")
+
+
+async def add_turns(storage, count, first=0):
+    await storage.add_conversations("u", [(f"t{n}", "user") for n in range(first, first + count)])
+
+
+def messages(body):
+    return [turn["message"] for turn in body["conversations"]]
+
+
+async def test_limit_without_cursor_returns_latest_turns(api_client, storage):
+    await add_turns(storage, 5)
+    body = (await api_client.get("/users/u/conversations", params={"limit": 2})).json()
+    assert messages(body) == ["t3", "t4"]
+    assert (body["since"], body["cursor"], body["total"], body["has_more"]) == (3, 5, 5, False)
+
+
+async def test_cursor_pages_forward(api_client, storage):
+    await add_turns(storage, 5)
+    first = (await api_client.get("/users/u/conversations", params={"since": 1, "limit": 2})).json()
+    assert messages(first) == ["t1", "t2"]
+    assert (first["cursor"], first["has_more"]) == (3, True)
+
+    rest = (await api_client.get("/users/u/conversations", params={"since": first["cursor"]})).json()
+    assert messages(rest) == ["t3", "t4"]
+    assert (rest["cursor"], rest["has_more"]) == (5, False)
+
+
+async def test_cursor_at_or_past_the_end_is_empty(api_client, storage):
+    await add_turns(storage, 3)
+    for since in (3, 10):
+        body = (await api_client.get("/users/u/conversations", params={"since": since})).json()
+        assert body["conversations"] == []
+        assert body["has_more"] is False
+        assert body["cursor"] == body["since"] <= since
+
+
+async def test_cursor_older_than_kept_history_starts_at_first_kept_turn(api_client, storage):
+    await add_turns(storage, MAX_CONVERSATION_HISTORY + 10)
+    body = (await api_client.get("/users/u/conversations", params={"since": 3, "limit": 5})).json()
+    assert body["since"] == 10
+    assert messages(body) == [f"t{n}" for n in range(10, 15)]
+    assert body["has_more"] is True
+
+    body = (await api_client.get("/users/u/conversations")).json()
+    assert len(body["conversations"]) == MAX_CONVERSATION_HISTORY
+    assert (body["since"], body["cursor"], body["total"]) == (10, 60, 60)
+
+
+async def test_unknown_user_has_no_turns(api_client):
+    body = (await api_client.get("/users/nobody/conversations")).json()
+    assert (body["conversations"], body["total"], body["has_more"]) == ([], 0, False)
+
+
+async def test_conversations_revalidate_with_etag(api_client, storage):
+    await add_turns(storage, 2)
+    response = await api_client.get("/users/u/conversations")
+    etag = response.headers["ETag"]
+    assert etag == '"2"'
+
+    cached = await api_client.get("/users/u/conversations", headers={"If-None-Match": f"W/{etag}"})
+    assert cached.status_code == 304
+
+    await add_turns(storage, 1, first=2)
+    fresh = await api_client.get("/users/u/conversations", headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert fresh.headers["ETag"] == '"3"'
+
+
+async def test_memory_delta_and_etag(api_client, storage):
+    await add_turns(storage, MAX_CONVERSATION_HISTORY + 4)
+    response = await api_client.get("/users/u/memory", params={"since": 52})
+    assert [turn["message"] for turn in response.json()["conversation_history"]] == ["t52", "t53"]
+
+    # Older than anything kept: everything kept
+    trimmed = (await api_client.get("/users/u/memory", params={"since": 0})).json()
+    assert len(trimmed["conversation_history"]) == MAX_CONVERSATION_HISTORY
+    past_end = (await api_client.get("/users/u/memory", params={"since": 99})).json()
+    assert past_end["conversation_history"] == []
+
+    cached = await api_client.get("/users/u/memory", headers={"If-None-Match": response.headers["ETag"]})
+    assert cached.status_code == 304
+    await storage.save_summary("u", "so far", 10)
+    assert (await api_client.get("/users/u/memory", headers={"If-None-Match": response.headers["ETag"]})).status_code == 200
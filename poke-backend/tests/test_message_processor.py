@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeChatModel, wait_for_response
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_cancelled_turn_is_left_for_reclaim(make_processor, storage, monkeypatch):
+    acked = []
+
+    async def ack(message):
+        acked.append(message.message_id)
+
+    monkeypatch.setattr(storage, "ack", ack)
+    processor = make_processor(FakeChatModel(delay=5))
+    workers = asyncio.create_task(processor.start_processing())
+
+    message_id = await processor.queue_user_message("u", "hi")
+    await asyncio.sleep(0.1)
+    await processor.stop_processing()
+    await asyncio.gather(workers, return_exceptions=True)
+
+    assert acked == []
+    assert await storage.get_in_flight("u") == (1, 1)
+    assert (await processor.get_message_response(message_id))["status"] == "processing"
+
+
+async def test_failed_turn_is_acked(make_processor, storage, monkeypatch):
+    acked = []
+
+    async def ack(message):
+        acked.append(message.message_id)
+
+    monkeypatch.setattr(storage, "ack", ack)
+    processor = make_processor(FakeChatModel(replies=[None]))
+    workers = asyncio.create_task(processor.start_processing())
+
+    message_id = await processor.queue_user_message("u", "hi")
+    assert (await wait_for_response(processor, message_id))["status"] == "error"
+    assert acked == [message_id]
+    assert await storage.get_in_flight("u") == (0, 0)
+
+    await processor.stop_processing()
+    workers.cancel()
+
+
+async def test_research_turn_does_not_hold_up_chat(make_processor, monkeypatch):
+    processor = make_processor(FakeChatModel())
+    release = asyncio.Event()
+    done = []
+
+    async def process_message(message):
+        if message.lane == "research":
+            await release.wait()
+        done.append(message.lane)
+
+    monkeypatch.setattr(processor, "_process_message", process_message)
+    workers = asyncio.create_task(processor.start_processing())
+
+    await processor.queue_user_message("u", "Research this user automatically")
+    await processor.queue_user_message("u", "hi")
+    await processor.queue_user_message("u", "Research this user automatically, again")
+    await asyncio.sleep(0.2)
+    assert done == ["chat"]
+
+    release.set()
+    await asyncio.sleep(0.1)
+    # Research still runs one turn at a time, in order
+    assert done == ["chat", "research", "research"]
+    await processor.stop_processing()
+    await asyncio.gather(workers, return_exceptions=True)
+
+
+async def test_summary_runs_outside_the_turn(make_processor, monkeypatch):
+    processor = make_processor(FakeChatModel(), num_workers=1)
+    summarising = asyncio.Event()
+
+    async def update_summary(memory):
+        summarising.set()
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(processor.context, "update_summary", update_summary)
+    workers = asyncio.create_task(processor.start_processing())
+
+    first = await processor.queue_user_message("u", "hi")
+    assert (await wait_for_response(processor, first))["status"] == "completed"
+    await asyncio.wait_for(summarising.wait(), 1)
+    # The only worker is free for the next message while the summary runs
+    second = await processor.queue_user_message("u", "again")
+    assert (await wait_for_response(processor, second, timeout=1))["status"] == "completed"
+
+    await processor.stop_processing()
+    await asyncio.gather(workers, return_exceptions=True)
+    assert not processor._summary_tasks
@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RECORD = "from server.metrics import COALESCED; COALESCED.inc()"
+SCRAPE = "import asyncio; from server import api; print(asyncio.run(api.metrics()).body.decode())"
+
+
+def run(code, metrics_dir):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(metrics_dir)}
+    return subprocess.run(
+        [sys.executable, "-c", code], env=env, cwd=ROOT, check=True, capture_output=True, text=True
+    ).stdout
+
+
+def test_metrics_add_up_across_api_processes(tmp_path):
+    run(RECORD, tmp_path)
+    run(RECORD, tmp_path)
+    assert "poke_messages_coalesced_total 2.0" in run(SCRAPE, tmp_path)
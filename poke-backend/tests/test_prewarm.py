@@ -0,0 +1,31 @@
+import asyncio
+
+import pytest
+
+from conftest import FakeChatModel, wait_for_response
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_prewarm_runs_on_the_research_lane(make_processor, storage):
+    model = FakeChatModel(replies=["So you are Ada"], delay=0.2)
+    processor = make_processor(model)
+    prewarmer = processor.prewarmer
+
+    assert await prewarmer.start("u")
+    assert not await prewarmer.start("u")
+    assert (await storage.lane_depths())["research"] == 1
+    assert await storage.get_in_flight("u") == (1, 1)
+
+    workers = asyncio.create_task(processor.start_processing())
+    # Queued while the speculative turn is still running
+    await asyncio.sleep(0.05)
+    message_id = await processor.queue_user_message("u", "Hello Poke")
+    response = await wait_for_response(processor, message_id)
+
+    assert response["response"] == "So you are Ada"
+    assert model.calls == 1
+    assert prewarmer.hits == 1
+    assert await storage.get_in_flight("u") == (0, 0)
+    await processor.stop_processing()
+    await asyncio.gather(workers, return_exceptions=True)
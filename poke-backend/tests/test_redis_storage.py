@@ -0,0 +1,153 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from server.lanes import CHAT
+from server.models import Message
+from server.storage import RedisStorage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+def make_storage(server, consumer):
+    return RedisStorage(client=fakeredis.aioredis.FakeRedis(server=server, decode_responses=True), consumer=consumer)
+
+
+def message(n, user_id="u"):
+    return Message(user_id=user_id, content=f"m{n}", message_type="user", message_id=f"m{n}", lane=CHAT)
+
+
+async def queue_two(server):
+    """Queue two messages for one user and hand one to each of two consumers"""
+    first, second = make_storage(server, "a"), make_storage(server, "b")
+    await first.enqueue(message(1))
+    await first.enqueue(message(2))
+    return (first, await first.dequeue()), (second, await second.dequeue())
+
+
+async def test_user_turn_waits_for_earlier_message_on_another_consumer(redis_server):
+    (first, m1), (second, m2) = await queue_two(redis_server)
+    assert (m1.message_id, m2.message_id) == ("m1", "m2")
+
+    entered = asyncio.Event()
+
+    async def run_second():
+        async with second.user_turn(m2):
+            entered.set()
+
+    waiter = asyncio.create_task(run_second())
+    async with first.user_turn(m1):
+        await asyncio.sleep(0.2)
+        assert not entered.is_set()
+        await first.ack(m1)
+    # Woken by the finished turn, well before the fallback recheck
+    await asyncio.wait_for(entered.wait(), 1)
+    await waiter
+
+
+async def test_user_turn_skips_deleted_earlier_message(redis_server):
+    (first, m1), (second, m2) = await queue_two(redis_server)
+    # Lost without ever finishing, e.g. deleted by hand
+    await first.ack(m1)
+
+    async def run_second():
+        async with second.user_turn(m2):
+            pass
+
+    await asyncio.wait_for(run_second(), 1)
+
+
+async def test_cancelled_turn_keeps_later_messages_waiting(redis_server):
+    (first, m1), (second, m2) = await queue_two(redis_server)
+
+    async def run_first():
+        async with first.user_turn(m1):
+            await asyncio.sleep(10)
+
+    running = asyncio.create_task(run_first())
+    await asyncio.sleep(0.05)
+    running.cancel()
+    await asyncio.gather(running, return_exceptions=True)
+
+    async def run_second():
+        async with second.user_turn(m2):
+            pass
+
+    # m1 is still pending for reclaim, so m2 must not jump ahead of it
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(run_second(), 0.3)
+
+
+async def test_reclaimed_earlier_message_runs_before_later_one(redis_server, tools, monkeypatch):
+    from server.message_processor import MessageProcessor
+
+    from conftest import FakeChatModel
+
+    monkeypatch.setattr("server.storage.REDIS_CLAIM_IDLE_MS", 100)
+    storage = make_storage(redis_server, "live")
+    processor = MessageProcessor(storage, num_workers=2)
+    processor.agent.model = processor.context.model = FakeChatModel()
+
+    first = await processor.queue_user_message("u", "first")
+    second = await processor.queue_user_message("u", "second")
+    # A worker that died holding the first message
+    assert (await make_storage(redis_server, "dead").dequeue()).message_id == first
+
+    # Drive the processor by hand, as fakeredis doesn't really block in
+    # XREADGROUP and a worker loop would never yield to cancellation
+    later = await storage.dequeue()
+    assert later.message_id == second
+    running = asyncio.create_task(processor._process_user_messages(later))
+    await asyncio.sleep(0.15)
+    # Nothing new is queued, so this reclaims the dead worker's message
+    reclaimed = await storage.dequeue()
+    assert reclaimed.message_id == first
+    await asyncio.wait_for(asyncio.gather(processor._process_user_messages(reclaimed), running), 5)
+
+    assert (await storage.get_response(first))["status"] == "completed"
+    assert (await storage.get_response(second))["status"] == "completed"
+    turns = [turn["message"] for turn in await storage.get_conversations("u")]
+    assert turns[::2] == ["first", "second"]
+
+
+async def test_finished_users_leave_in_flight_hash(redis_server):
+    storage = make_storage(redis_server, "a")
+    await storage.track_in_flight("u", 1)
+    await storage.track_in_flight("v", 1)
+    await storage.track_in_flight("u", -1)
+
+    assert await storage.redis.hgetall("poke:in_flight:users") == {"v": "1"}
+    assert await storage.get_in_flight("u") == (1, 0)
+
+
+async def test_bridged_game_mark_survives_patches(redis_server):
+    storage = make_storage(redis_server, "a")
+    await storage.save_game_state("u", {"hp": 1}, bridged=True)
+    await storage.save_game_state("u", {"hp": 2}, expected_version=1)
+    assert await storage.is_bridged_game("u")
+
+    await storage.save_game_state("u", {"hp": 3}, bridged=False)
+    assert not await storage.is_bridged_game("u")
+
+
+async def test_dead_consumers_message_is_reclaimed_under_load(redis_server, monkeypatch):
+    monkeypatch.setattr("server.storage.REDIS_CLAIM_IDLE_MS", 100)
+    live = make_storage(redis_server, "live")
+    await live.enqueue(message(0, user_id="dead"))
+    assert (await make_storage(redis_server, "dead").dequeue()).message_id == "m0"
+
+    # New work keeps arriving, so the streams never go quiet
+    seen = []
+    for n in range(1, 40):
+        await live.enqueue(message(n, user_id=f"user-{n}"))
+        seen.append((await live.dequeue()).message_id)
+        if "m0" in seen:
+            break
+        await asyncio.sleep(0.01)
+    assert "m0" in seen
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+
+from dotenv import load_dotenv
+
+
+async def run_worker(num_workers: int, metrics_port: int = 0):
+    """Drain the shared message queue until SIGINT/SIGTERM"""
+    from prometheus_client import start_http_server
+
+    from server.cassette import cassette
+    from server.clients import close_clients
+    from server.message_processor import MessageProcessor
+    from server.storage import create_storage
+
+    if metrics_port:
+        # Workers run the agent turns, so they serve their own /metrics
+        start_http_server(metrics_port)
+
+    storage = create_storage()
+    processor = MessageProcessor(storage, num_workers=num_workers)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: asyncio.create_task(processor.stop_processing()))
+
+    try:
+        await processor.start_processing()
+    finally:
+        await storage.close()
+        await close_clients()
+        if cassette:
+            cassette.close()
+
+
+def _run_process(num_workers: int, metrics_port: int = 0):
+    load_dotenv()
+    asyncio.run(run_worker(num_workers, metrics_port))
+
+
+def main():
+    """Run agent workers that consume the queue shared with the API"""
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Poke AI message workers")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=int(os.getenv("WORKER_PROCESSES", "1")),
+        help="Number of worker processes, typically one per core",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("MESSAGE_WORKERS", "4")),
+        help="Async workers per process",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=int(os.getenv("WORKER_METRICS_PORT", "0")),
+        help="Serve Prometheus metrics from this port, the next one for each further process (0 = off)",
+    )
+    args = parser.parse_args()
+
+    if os.getenv("STORAGE_BACKEND", "memory") != "redis":
+        print("❌ poke-worker needs STORAGE_BACKEND=redis to share the queue with the API")
+        return
+
+    if args.processes == 1:
+        _run_process(args.concurrency, args.metrics_port)
+        return
+
+    processes = [
+        multiprocessing.Process(
+            target=_run_process,
+            args=(args.concurrency, args.metrics_port + i if args.metrics_port else 0),
+            name=f"poke-worker-{i}",
+        )
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def stop_children(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    # Children get their own SIGINT from the terminal; forward SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_children)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -117,7 +117,7 @@ function App() {
     setIsTyping(true);
     try {
       // Send an initial message to trigger Poke's research
-      await apiClient.sendMessage(userIdToUse, "Hello Poke! Tell me what you've discovered about me.");
+      const result = await apiClient.sendMessage(userIdToUse, "Hello Poke! Tell me what you've discovered about me.");
       
       // Add a placeholder agent message while waiting for the actual response
       const agentMessage: Message = {
@@ -129,8 +129,8 @@ function App() {
       
       setMessages([agentMessage]);
       
-      // Poll for real responses from the backend
-      pollForResponses(userIdToUse);
+      // Stream the research result, falling back to polling the conversation
+      streamMessageResponse(result.message_id, () => pollForResponses(userIdToUse));
       
     } catch (error) {
       console.error('Failed to send initial message:', error);
@@ -186,6 +186,57 @@ function App() {
     poll();
   };
 
+  const streamMessageResponse = (messageId: string, onFallback: () => void) => {
+    const agentMessageId = `msg_${Date.now()}_stream`;
+    let content = '';
+
+    const showAgentMessage = (text: string) => {
+      const agentMessage: Message = {
+        id: agentMessageId,
+        content: text,
+        sender: 'agent',
+        timestamp: new Date(),
+      };
+      setMessages(prev =>
+        prev.some(msg => msg.id === agentMessageId)
+          ? prev.map(msg => (msg.id === agentMessageId ? agentMessage : msg))
+          : [...prev, agentMessage]
+      );
+    };
+
+    const removeAgentMessage = () => {
+      setMessages(prev => prev.filter(msg => msg.id !== agentMessageId));
+    };
+
+    apiClient.streamMessageResponse(messageId, {
+      onToken: (token) => {
+        content += token;
+        setIsTyping(false);
+        showAgentMessage(content);
+      },
+      onToolStart: () => {
+        // Text before a tool call is the model thinking aloud; drop it
+        content = '';
+        removeAgentMessage();
+        setIsTyping(true);
+      },
+      onDone: (status, response) => {
+        showAgentMessage(
+          status === 'completed' && response
+            ? response
+            : "Sorry, I encountered an error processing your message."
+        );
+        setIsTyping(false);
+      },
+      onError: () => {
+        // Streaming unavailable or interrupted; poll for the result instead
+        removeAgentMessage();
+        setIsTyping(true);
+        onFallback();
+      },
+    });
+  };
+
   const pollForMessageResponse = async (messageId: string) => {
     let attempts = 0;
     const maxAttempts = 30; // 2.5 minutes of polling (30 * 5 seconds)
@@ -277,11 +328,11 @@ function App() {
         )
       );
 
-      // Show typing indicator and poll for specific message response
+      // Show typing indicator and stream the specific message response
       setIsTyping(true);
       
-      // Poll for the specific message response
-      pollForMessageResponse(result.message_id);
+      // Stream the response, polling for it if the stream fails
+      streamMessageResponse(result.message_id, () => pollForMessageResponse(result.message_id));
 
     } catch (error) {
       console.error('Failed to send message:', error);
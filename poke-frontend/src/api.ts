@@ -1,3 +1,5 @@
+import type { ConnectionStatus, StreamHandlers } from './types';
+
 const API_BASE_URL = 'http://localhost:8000';
 
 export class ApiClient {
@@ -65,6 +67,25 @@ export class ApiClient {
     return response.json();
   }
 
+  // Long-polls: the server answers as soon as the status differs from lastStatus
+  async waitForConnectionStatus(
+    connectionId: string,
+    lastStatus: string | null,
+    waitSeconds: number = 25,
+  ): Promise<ConnectionStatus> {
+    const params = new URLSearchParams({ wait: String(waitSeconds) });
+    if (lastStatus) {
+      params.set('last_status', lastStatus);
+    }
+    const response = await fetch(`${this.baseUrl}/connections/${connectionId}/status?${params}`);
+    
+    if (!response.ok) {
+      throw new Error(`Failed to check connection status: ${response.statusText}`);
+    }
+
+    return response.json();
+  }
+
   async sendMessage(userId: string, content: string): Promise<any> {
     const response = await fetch(`${this.baseUrl}/messages`, {
       method: 'POST',
@@ -94,6 +115,32 @@ export class ApiClient {
     return response.json();
   }
 
+  streamMessageResponse(messageId: string, handlers: StreamHandlers): EventSource {
+    const source = new EventSource(`${this.baseUrl}/messages/${messageId}/stream`);
+
+    source.addEventListener('token', (event) => {
+      handlers.onToken(JSON.parse((event as MessageEvent).data).content);
+    });
+
+    source.addEventListener('tool_start', (event) => {
+      handlers.onToolStart?.(JSON.parse((event as MessageEvent).data).tool);
+    });
+
+    source.addEventListener('done', (event) => {
+      // Close before the server ends the stream so onerror doesn't fire
+      source.close();
+      const data = JSON.parse((event as MessageEvent).data);
+      handlers.onDone(data.status, data.response);
+    });
+
+    source.onerror = () => {
+      source.close();
+      handlers.onError();
+    };
+
+    return source;
+  }
+
   async getUserMemory(userId: string): Promise<any> {
     const response = await fetch(`${this.baseUrl}/users/${userId}/memory`);
     
@@ -1,4 +1,4 @@
-import { useState } from 'react';
+import { useEffect, useRef, useState } from 'react';
 import { Mail, User, Loader2, ExternalLink } from 'lucide-react';
 import { apiClient } from '../api';
 
@@ -59,6 +59,43 @@ export function ConnectionSetup({ onConnectionEstablished }: ConnectionSetupProp
     }
   };
 
+  // Kept in a ref so a parent re-render doesn't restart the long-poll
+  const onEstablishedRef = useRef(onConnectionEstablished);
+  onEstablishedRef.current = onConnectionEstablished;
+
+  // Long-poll the connection so authorization is picked up without a click
+  useEffect(() => {
+    if (step !== 'auth' || !connectionData?.connectionId) return;
+
+    let cancelled = false;
+    const watch = async () => {
+      let lastStatus: string | null = null;
+      while (!cancelled) {
+        try {
+          const status = await apiClient.waitForConnectionStatus(connectionData.connectionId!, lastStatus);
+          if (cancelled) return;
+          if (status.status === 'ACTIVE') {
+            onEstablishedRef.current(connectionData.userId);
+            return;
+          }
+          if (status.status === 'FAILED' || status.status === 'EXPIRED') {
+            setError('Gmail authorization failed, please try again');
+            return;
+          }
+          lastStatus = status.status;
+        } catch (err) {
+          // Back off briefly, the button below still works meanwhile
+          await new Promise(resolve => setTimeout(resolve, 5000));
+        }
+      }
+    };
+
+    watch();
+    return () => {
+      cancelled = true;
+    };
+  }, [step, connectionData]);
+
   const checkConnectionStatus = async () => {
     if (!connectionData?.connectionId) return;
 
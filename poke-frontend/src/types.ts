@@ -18,4 +18,11 @@ export interface ConnectionStatus {
   status: string;
   connection_id: string;
   redirect_url?: string;
+}
+
+export interface StreamHandlers {
+  onToken: (content: string) => void;
+  onToolStart?: (tool: string) => void;
+  onDone: (status: 'completed' | 'error', response: string | null) => void;
+  onError: () => void;
 }
\ No newline at end of file